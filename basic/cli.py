@@ -14,8 +14,9 @@ flags.DEFINE_string("out_base_dir", "out", "out base dir [out]")
 flags.DEFINE_string("forward_name", "single", "Forward name [single]")
 flags.DEFINE_string("answer_path", "", "Answer path []")
 flags.DEFINE_string("eval_path", "", "Eval path []")
-flags.DEFINE_string("load_path", "", "Load path []")
-flags.DEFINE_string("shared_path", "", "Shared path []")
+flags.DEFINE_string("load_path", "", "Load path, comma-separated in ensemble mode []")
+flags.DEFINE_string("shared_path", "", "Shared path, comma-separated (one per load path) in ensemble mode []")
+flags.DEFINE_string("frozen_path", "", "Frozen graph written by export mode (default: save_dir/frozen.pb), used by forward mode if set []")
 
 # Device placement
 flags.DEFINE_string("device", "/cpu:0", "default device for summing gradients. [/cpu:0]")
@@ -23,7 +24,7 @@ flags.DEFINE_string("device_type", "gpu", "device for computing gradients (paral
 flags.DEFINE_integer("num_gpus", 1, "num of gpus or cpus for computing gradients [1]")
 
 # Essential training and test options
-flags.DEFINE_string("mode", "test", "trains | test | forward [test]")
+flags.DEFINE_string("mode", "test", "trains | test | forward | bench_feed | serve | ensemble | export [test]")
 flags.DEFINE_boolean("load", True, "load saved data? [True]")
 flags.DEFINE_bool("single", False, "supervise only the answer sentence? [False]")
 flags.DEFINE_boolean("debug", False, "Debugging mode? [False]")
@@ -54,9 +55,13 @@ flags.DEFINE_bool("share_lstm_weights", True, "Share pre-processing (phrase-leve
 flags.DEFINE_float("var_decay", 0.999, "Exponential moving average decay for variables [0.999]")
 
 # Optimizations
-flags.DEFINE_bool("cluster", False, "Cluster data for faster training [False]")
+flags.DEFINE_bool("cluster", False, "Bucket training data by paragraph and question lengths for faster training [False]")
+flags.DEFINE_integer("token_budget", 0, "Max padded context tokens (N x M x JX) per batch (per tower) instead of batch_size examples, 0 to disable; requires cluster, len_opt and cpu_opt [0]")
 flags.DEFINE_bool("len_opt", False, "Length optimization? [False]")
 flags.DEFINE_bool("cpu_opt", False, "CPU optimization? GPU computation can be slower [False]")
+flags.DEFINE_bool("dedup_x", False, "Encode each paragraph of a batch once for all of its questions when not training? [False]")
+flags.DEFINE_integer("prefetch_depth", 2, "Number of batches (with feed dicts) prepared ahead in a background thread, 0 to disable [2]")
+flags.DEFINE_bool("columnar", False, "Read memory-mapped columnar data (squad.prepro --columnar)? [False]")
 
 # Logging and saving options
 flags.DEFINE_boolean("progress", True, "Show progress? [True]")
@@ -64,11 +69,16 @@ flags.DEFINE_integer("log_period", 100, "Log period [100]")
 flags.DEFINE_integer("eval_period", 1000, "Eval period [1000]")
 flags.DEFINE_integer("save_period", 1000, "Save Period [1000]")
 flags.DEFINE_integer("max_to_keep", 20, "Max recent saves to keep [20]")
+flags.DEFINE_bool("async_save", False, "Write checkpoints in a background thread? [False]")
 flags.DEFINE_bool("dump_eval", True, "dump eval? [True]")
 flags.DEFINE_bool("dump_answer", True, "dump answer? [True]")
 flags.DEFINE_bool("vis", False, "output visualization numbers? [False]")
 flags.DEFINE_bool("dump_pickle", True, "Dump pickle instead of json? [True]")
+flags.DEFINE_bool("dump_binary", False, "Dump eval as a directory of (unpadded) binary arrays instead of pickle or json? [False]")
+flags.DEFINE_string("binary_dtype", "float16", "float16 | float32, dtype of the binary eval dump [float16]")
 flags.DEFINE_float("decay", 0.9, "Exponential moving average decay for logging values [0.9]")
+flags.DEFINE_string("ensemble_func", "ensemble3", "ensemble1 | ensemble2 | ensemble3, see basic.ensemble [ensemble3]")
+flags.DEFINE_integer("max_answer_len", 0, "Max answer length in words when decoding spans, 0 for no limit [0]")
 
 # Thresholds for speed and less memory usage
 flags.DEFINE_integer("word_count_th", 10, "word count th [100]")
@@ -87,6 +97,7 @@ flags.DEFINE_string("data_filter", "max", "max | valid | semi [max]")
 flags.DEFINE_bool("use_glove_for_unk", True, "use glove for unk [False]")
 flags.DEFINE_bool("known_if_glove", True, "consider as known if present in glove [False]")
 flags.DEFINE_string("logit_func", "tri_linear", "logit func [tri_linear]")
+flags.DEFINE_bool("lean_att", False, "Compute the attention logits without tiling h and u to [N, M, JX, JQ, 2d]? (linear | tri_linear | dot) [False]")
 flags.DEFINE_string("answer_func", "linear", "answer logit func [linear]")
 flags.DEFINE_string("sh_logit_func", "tri_linear", "sh logit func [tri_linear]")
 
@@ -97,6 +108,20 @@ flags.DEFINE_bool("q2c_att", True, "question-to-context attention? [True]")
 flags.DEFINE_bool("c2q_att", True, "context-to-question attention? [True]")
 flags.DEFINE_bool("dynamic_att", False, "Dynamic attention [False]")
 
+# Serving options
+flags.DEFINE_string("serve_host", "localhost", "Host to serve on [localhost]")
+flags.DEFINE_integer("serve_port", 8000, "Port to serve on, 0 to read json lines from stdin [8000]")
+flags.DEFINE_float("batch_window", 5.0, "Max milliseconds to wait for more requests to fill a batch when serving [5.0]")
+flags.DEFINE_integer("context_cache_mb", 64, "Size of the LRU cache of tokenized contexts when serving, 0 to disable [64]")
+flags.DEFINE_bool("cache_h", False, "Also cache the context encodings (h) when serving? [False]")
+flags.DEFINE_string("tokenizer", "PTB", "PTB | Stanford [PTB]")
+flags.DEFINE_bool("split", False, "Split contexts into sentences (same as squad.prepro --split)? [False]")
+flags.DEFINE_string("corenlp_url", "vision-server2.corp.ai2", "CoreNLP server url for the Stanford tokenizer [vision-server2.corp.ai2]")
+flags.DEFINE_integer("corenlp_port", 8000, "CoreNLP server port for the Stanford tokenizer [8000]")
+flags.DEFINE_string("glove_dir", os.path.join(os.path.expanduser("~"), "data", "glove"), "GloVe dir [~/data/glove]")
+flags.DEFINE_string("glove_corpus", "6B", "GloVe corpus [6B]")
+flags.DEFINE_integer("glove_vec_size", 100, "GloVe vector size [100]")
+
 
 def main(_):
     config = flags.FLAGS
@@ -1,13 +1,19 @@
 import argparse
 import functools
 import gzip
+import itertools
 import json
+import math
+import multiprocessing
+import os
 import pickle
 from collections import defaultdict
 from operator import mul
 
+import numpy as np
 from tqdm import tqdm
-from squad.utils import get_phrase, get_best_span
+from my.columnar import load_ragged_dict
+from squad.utils import get_phrase, get_best_span, get_best_spans
 
 
 def get_args():
@@ -16,39 +22,168 @@ def get_args():
     parser.add_argument('-o', '--out', default='ensemble.json')
     parser.add_argument("--data_path", default="data/squad/data_test.json")
     parser.add_argument("--shared_path", default="data/squad/shared_test.json")
+    parser.add_argument("--func", default="ensemble3", help="ensemble1 | ensemble2 | ensemble3")
+    parser.add_argument("--num_workers", default=multiprocessing.cpu_count(), type=int)
+    parser.add_argument("--chunk_size", default=1024, type=int, help="examples converted to arrays at a time")
     args = parser.parse_args()
     return args
 
 
-def ensemble(args):
-    e_list = []
-    for path in tqdm(args.paths):
+def load_yps(path):
+    """
+    :param path: eval pickle or binary eval directory (--dump_binary) dumped by GraphHandler.dump_eval
+    :return: (yp, yp2), lists of per-example start and stop probs
+        (memory-mapped RaggedArrays for a binary eval; a pickle is loaded whole)
+    """
+    if os.path.isdir(path):
+        e = load_ragged_dict(path)
+    else:
         with gzip.open(path, 'r') as fh:
             e = pickle.load(fh)
-            e_list.append(e)
+    return e['yp'], e['yp2']
+
+
+def get_best_spans_by_shape(yp_list, yp2_list):
+    """
+    get_best_span for each example, with one vectorized get_best_spans call per distinct example shape.
+    """
+    spans, scores = [None] * len(yp_list), [None] * len(yp_list)
+    shape2idxs = defaultdict(list)
+    for i, (ypi, yp2i) in enumerate(zip(yp_list, yp2_list)):
+        shape2idxs[tuple(np.maximum(np.shape(ypi), np.shape(yp2i)))].append(i)
+    for shape, idxs in shape2idxs.items():
+        each_spans, each_scores = get_best_spans(np.array([_pad(yp_list[i], shape) for i in idxs]),
+                                                 np.array([_pad(yp2_list[i], shape) for i in idxs]))
+        for i, span, score in zip(idxs, each_spans, each_scores):
+            spans[i], scores[i] = span, score
+    return spans, scores
+
+
+def _combine(func, context, wordss, items):
+    if func == 'ensemble1':
+        return get_phrase(context, wordss, items)
+    elif func == 'ensemble2':
+        return get_phrase(context, wordss, vote_start_stop(*zip(*items)))
+    elif func == 'ensemble3':
+        return vote_phrase(context, wordss, *zip(*items))
+    raise ValueError("invalid ensemble func: {}".format(func))
+
+
+def _combine_shard(func, shard):
+    return [_combine(func, *each) for each in shard]
 
+
+def ensemble(args):
+    """
+    Models are loaded one at a time and reduced to what the ensemble func needs
+    (the running product of the probs for ensemble1, the best span of each model otherwise),
+    then the answers are computed over question shards in a process pool.
+    The probs of a model are converted args.chunk_size examples at a time. Only binary evals (--dump_binary)
+    are read from disk as they are used, so memory stays bounded by a chunk (plus the product for ensemble1);
+    a pickled eval is unpickled whole first.
+    """
     with open(args.data_path, 'r') as fh:
         data = json.load(fh)
 
     with open(args.shared_path, 'r') as fh:
         shared = json.load(fh)
 
-    out = {}
-    for idx, (id_, rx) in tqdm(enumerate(zip(data['ids'], data['*x'])), total=len(e['yp'])):
-        if idx >= len(e['yp']):
-            # for debugging purpose
-            break
-        context = shared['p'][rx[0]][rx[1]]
-        wordss = shared['x'][rx[0]][rx[1]]
-        yp_list = [e['yp'][idx] for e in e_list]
-        yp2_list = [e['yp2'][idx] for e in e_list]
-        answer = ensemble3(context, wordss, yp_list, yp2_list)
-        out[id_] = answer
+    num_examples = len(data['ids'])
+    prods, prods2 = None, None
+    items = [[] for _ in range(num_examples)]
+    for path in tqdm(args.paths):
+        yp, yp2 = load_yps(path)
+        # for debugging purpose, only the examples evaluated by every model are answered
+        num_examples = min(num_examples, len(yp))
+        first = prods is None
+        if first:
+            prods, prods2 = [], []
+        for start in range(0, num_examples, args.chunk_size):
+            idxs = range(start, min(start + args.chunk_size, num_examples))
+            yp_chunk, yp2_chunk = [np.array(yp[i]) for i in idxs], [np.array(yp2[i]) for i in idxs]
+            if args.func == 'ensemble1':
+                # binary evals are read as float32 (even when dumped as float16), so the products stay float32
+                if first:
+                    prods.extend(yp_chunk)
+                    prods2.extend(yp2_chunk)
+                else:
+                    for i, ypi, yp2i in zip(idxs, yp_chunk, yp2_chunk):
+                        prods[i], prods2[i] = _crop_mul(prods[i], ypi), _crop_mul(prods2[i], yp2i)
+                continue
+            spans, scores = get_best_spans_by_shape(yp_chunk, yp2_chunk)
+            for i, ypi, yp2i, span, score in zip(idxs, yp_chunk, yp2_chunk, spans, scores):
+                if args.func == 'ensemble2':
+                    items[i].append((span, float(ypi[span[0][0]][span[0][1]]), _get_stop_prob(yp2i, span)))
+                else:
+                    items[i].append((span, score))
+        del yp, yp2
+    if args.func == 'ensemble1':
+        items, _ = get_best_spans_by_shape(prods[:num_examples], prods2[:num_examples])
+
+    inputs = []
+    for idx in range(num_examples):
+        rx = data['*x'][idx]
+        inputs.append((shared['p'][rx[0]][rx[1]], shared['x'][rx[0]][rx[1]], items[idx]))
+    shard_size = max(1, int(math.ceil(len(inputs) / (args.num_workers * 8))))
+    shards = [inputs[i:i + shard_size] for i in range(0, len(inputs), shard_size)]
+    combine_shard = functools.partial(_combine_shard, args.func)
+    if args.num_workers > 1:
+        with multiprocessing.Pool(args.num_workers) as pool:
+            answer_shards = list(tqdm(pool.imap(combine_shard, shards), total=len(shards)))
+    else:
+        answer_shards = [combine_shard(shard) for shard in tqdm(shards)]
 
+    answers = itertools.chain.from_iterable(answer_shards)
+    out = {id_: answer for id_, answer in zip(data['ids'][:num_examples], answers)}
     with open(args.out, 'w') as fh:
         json.dump(out, fh)
 
 
+def _pad(a, shape):
+    # binary eval dumps crop each example to its real sentences and tokens
+    a = np.asarray(a)
+    if a.shape == shape:
+        return a
+    return np.pad(a, [(0, each - size) for each, size in zip(shape, a.shape)], mode='constant')
+
+
+def _crop_mul(a, b):
+    # same as multiplying the nested lists element-wise with zip, which stops at the shorter one
+    m, j = min(a.shape[0], b.shape[0]), min(a.shape[1], b.shape[1])
+    return a[:m, :j] * b[:m, :j]
+
+
+def _get_stop_prob(y2, span):
+    # ensemble2 scores the stop with the exclusive stop index of the span
+    row = y2[span[1][0]]
+    return float(row[span[1][1]]) if span[1][1] < len(row) else 0.0
+
+
+def vote_start_stop(spans, start_probs, stop_probs):
+    """
+    The start and the stop with the largest summed probs over models, chosen independently.
+    """
+    start_dict = defaultdict(float)
+    stop_dict = defaultdict(float)
+    for span, start_prob, stop_prob in zip(spans, start_probs, stop_probs):
+        start_dict[span[0]] += start_prob
+        stop_dict[span[1]] += stop_prob
+    start = max(start_dict.items(), key=lambda pair: pair[1])[0]
+    stop = max(stop_dict.items(), key=lambda pair: pair[1])[0]
+    return start, stop
+
+
+def vote_phrase(context, wordss, spans, scores):
+    """
+    The phrase with the largest summed span score over models.
+    """
+    d = defaultdict(float)
+    for span, score in zip(spans, scores):
+        phrase = get_phrase(context, wordss, span)
+        d[phrase] += score
+    return max(d.items(), key=lambda pair: pair[1])[0]
+
+
 def ensemble1(context, wordss, y1_list, y2_list):
     """
 
@@ -65,25 +200,23 @@ def ensemble1(context, wordss, y1_list, y2_list):
 
 
 def ensemble2(context, wordss, y1_list, y2_list):
-    start_dict = defaultdict(float)
-    stop_dict = defaultdict(float)
-    for y1, y2 in zip(y1_list, y2_list):
-        span, score = get_best_span(y1, y2)
-        start_dict[span[0]] += y1[span[0][0]][span[0][1]]
-        stop_dict[span[1]] += y2[span[1][0]][span[1][1]]
-    start = max(start_dict.items(), key=lambda pair: pair[1])[0]
-    stop = max(stop_dict.items(), key=lambda pair: pair[1])[0]
-    best_span = (start, stop)
+    spans = [get_best_span(y1, y2)[0] for y1, y2 in zip(y1_list, y2_list)]
+    start_probs = [y1[span[0][0]][span[0][1]] for y1, span in zip(y1_list, spans)]
+    stop_probs = [_get_stop_prob(y2, span) for y2, span in zip(y2_list, spans)]
+    best_span = vote_start_stop(spans, start_probs, stop_probs)
     return get_phrase(context, wordss, best_span)
 
 
 def ensemble3(context, wordss, y1_list, y2_list):
-    d = defaultdict(float)
-    for y1, y2 in zip(y1_list, y2_list):
-        span, score = get_best_span(y1, y2)
-        phrase = get_phrase(context, wordss, span)
-        d[phrase] += score
-    return max(d.items(), key=lambda pair: pair[1])[0]
+    spans, scores = zip(*(get_best_span(y1, y2) for y1, y2 in zip(y1_list, y2_list)))
+    return vote_phrase(context, wordss, spans, scores)
+
+
+def get_ensemble_func(name):
+    funcs = {'ensemble1': ensemble1, 'ensemble2': ensemble2, 'ensemble3': ensemble3}
+    if name not in funcs:
+        raise ValueError("invalid ensemble func: {}".format(name))
+    return funcs[name]
 
 
 def combine_y_list(y_list, op='*'):
@@ -1,14 +1,86 @@
+import itertools
+
 import numpy as np
 import tensorflow as tf
 
 from basic.read_data import DataSet
 from my.nltk_utils import span_f1
 from my.tensorflow import padded_reshape
-from my.utils import argmax
-from squad.utils import get_phrase, get_best_span
+from my.utils import argmax, prefetch
+from squad.utils import get_phrase, get_best_spans
+
+
+def _concat(es, key):
+    return list(itertools.chain.from_iterable(getattr(e, key) for e in es))
+
+
+def _concat_tensor_dicts(es):
+    # lists of per-example values, so batches of different shapes (len_opt) are fine
+    if es[0].tensor_dict is None:
+        return None
+    return {key: list(itertools.chain.from_iterable(e.tensor_dict[key] for e in es)) for key in es[0].tensor_dict}
+
+
+def _get_x_lens(model, feed_dict, num_examples):
+    """
+    Number of tokens in each sentence of the first num_examples examples, from the x_mask fed to model
+    (trailing empty sentences are padding; every example keeps at least one sentence).
+    """
+    x_mask = feed_dict[model.x_mask]
+    if model.config.dedup_x:
+        x_mask = x_mask[feed_dict[model.x_idx]]
+    x_lens = []
+    for lens in x_mask[:num_examples].sum(2):
+        sents = np.flatnonzero(lens)
+        x_lens.append(lens[:sents[-1] + 1 if len(sents) > 0 else 1].tolist())
+    return x_lens
+
+
+def merge_evaluations(es):
+    """
+    from_evaluations of the type of es[0], keeping the x_lens of the evaluations if they all have them
+    """
+    e = type(es[0]).from_evaluations(es)
+    if all(each.x_lens is not None for each in es):
+        e.x_lens = _concat(es, 'x_lens')
+    return e
+
+
+def _mean_loss(es):
+    return sum(e.loss * e.num_examples for e in es) / sum(e.num_examples for e in es)
+
+
+def _merge_id2answer_dicts(es):
+    id2answer_dict, id2score_dict = {}, {}
+    for e in es:
+        id2answer_dict.update(e.id2answer_dict)
+        id2score_dict.update(e.id2answer_dict['scores'])
+    id2answer_dict['scores'] = id2score_dict
+    return id2answer_dict
+
+
+class EvaluationAccumulator(object):
+    """
+    Collects per-batch evaluations and merges them once into an evaluation of the same type.
+    """
+    def __init__(self):
+        self.evaluations = []
+
+    def add(self, e):
+        if not e.merge_tensor_dicts:
+            # the merged evaluation drops them, so per-batch tensors are not held for the whole eval
+            e.drop_tensor_dict()
+        self.evaluations.append(e)
+
+    def get(self):
+        if len(self.evaluations) == 0:
+            return None
+        return merge_evaluations(self.evaluations)
 
 
 class Evaluation(object):
+    merge_tensor_dicts = True
+
     def __init__(self, data_type, global_step, idxs, yp, tensor_dict=None):
         self.data_type = data_type
         self.global_step = global_step
@@ -16,13 +88,15 @@ class Evaluation(object):
         self.yp = yp
         self.num_examples = len(yp)
         self.tensor_dict = None
+        # tokens per sentence of each example, set by the evaluators that know them (see GraphHandler.dump_eval)
+        self.x_lens = None
         self.dict = {'data_type': data_type,
                      'global_step': global_step,
                      'yp': yp,
                      'idxs': idxs,
                      'num_examples': self.num_examples}
         if tensor_dict is not None:
-            self.tensor_dict = {key: val.tolist() for key, val in tensor_dict.items()}
+            self.tensor_dict = {key: val.tolist() if isinstance(val, np.ndarray) else val for key, val in tensor_dict.items()}
             for key, val in self.tensor_dict.items():
                 self.dict[key] = val
         self.summaries = None
@@ -30,17 +104,26 @@ class Evaluation(object):
     def __repr__(self):
         return "{} step {}".format(self.data_type, self.global_step)
 
+    def drop_tensor_dict(self):
+        if self.tensor_dict is not None:
+            for key in self.tensor_dict:
+                del self.dict[key]
+            self.tensor_dict = None
+
     def __add__(self, other):
         if other == 0:
             return self
-        assert self.data_type == other.data_type
-        assert self.global_step == other.global_step
-        new_yp = self.yp + other.yp
-        new_idxs = self.idxs + other.idxs
-        new_tensor_dict = None
-        if self.tensor_dict is not None:
-            new_tensor_dict = {key: val + other.tensor_dict[key] for key, val in self.tensor_dict.items()}
-        return Evaluation(self.data_type, self.global_step, new_idxs, new_yp, tensor_dict=new_tensor_dict)
+        return merge_evaluations([self, other])
+
+    @classmethod
+    def from_evaluations(cls, es):
+        """
+        Merge per-batch evaluations at once (linear in the total size, unlike chained additions).
+        """
+        e = es[0]
+        assert all(each.data_type == e.data_type and each.global_step == e.global_step for each in es)
+        return Evaluation(e.data_type, e.global_step, _concat(es, 'idxs'), _concat(es, 'yp'),
+                          tensor_dict=_concat_tensor_dicts(es))
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -52,17 +135,12 @@ class LabeledEvaluation(Evaluation):
         self.y = y
         self.dict['y'] = y
 
-    def __add__(self, other):
-        if other == 0:
-            return self
-        assert self.data_type == other.data_type
-        assert self.global_step == other.global_step
-        new_yp = self.yp + other.yp
-        new_y = self.y + other.y
-        new_idxs = self.idxs + other.idxs
-        if self.tensor_dict is not None:
-            new_tensor_dict = {key: np.concatenate((val, other.tensor_dict[key]), axis=0) for key, val in self.tensor_dict.items()}
-        return LabeledEvaluation(self.data_type, self.global_step, new_idxs, new_yp, new_y, tensor_dict=new_tensor_dict)
+    @classmethod
+    def from_evaluations(cls, es):
+        e = es[0]
+        assert all(each.data_type == e.data_type and each.global_step == e.global_step for each in es)
+        return LabeledEvaluation(e.data_type, e.global_step, _concat(es, 'idxs'), _concat(es, 'yp'), _concat(es, 'y'),
+                                 tensor_dict=_concat_tensor_dicts(es))
 
 
 class AccuracyEvaluation(LabeledEvaluation):
@@ -81,19 +159,12 @@ class AccuracyEvaluation(LabeledEvaluation):
     def __repr__(self):
         return "{} step {}: accuracy={}, loss={}".format(self.data_type, self.global_step, self.acc, self.loss)
 
-    def __add__(self, other):
-        if other == 0:
-            return self
-        assert self.data_type == other.data_type
-        assert self.global_step == other.global_step
-        new_idxs = self.idxs + other.idxs
-        new_yp = self.yp + other.yp
-        new_y = self.y + other.y
-        new_correct = self.correct + other.correct
-        new_loss = (self.loss * self.num_examples + other.loss * other.num_examples) / len(new_correct)
-        if self.tensor_dict is not None:
-            new_tensor_dict = {key: np.concatenate((val, other.tensor_dict[key]), axis=0) for key, val in self.tensor_dict.items()}
-        return AccuracyEvaluation(self.data_type, self.global_step, new_idxs, new_yp, new_y, new_correct, new_loss, tensor_dict=new_tensor_dict)
+    @classmethod
+    def from_evaluations(cls, es):
+        e = es[0]
+        assert all(each.data_type == e.data_type and each.global_step == e.global_step for each in es)
+        return AccuracyEvaluation(e.data_type, e.global_step, _concat(es, 'idxs'), _concat(es, 'yp'), _concat(es, 'y'),
+                                  _concat(es, 'correct'), _mean_loss(es), tensor_dict=_concat_tensor_dicts(es))
 
 
 class Evaluator(object):
@@ -104,18 +175,31 @@ class Evaluator(object):
         self.yp = model.yp
         self.tensor_dict = {} if tensor_dict is None else tensor_dict
 
-    def get_evaluation(self, sess, batch):
+    def get_evaluation(self, sess, batch, feed_dict=None):
         idxs, data_set = batch
-        feed_dict = self.model.get_feed_dict(data_set, False, supervised=False)
+        feed_dict = feed_dict or self._get_feed_dict(batch)
         global_step, yp, vals = sess.run([self.global_step, self.yp, list(self.tensor_dict.values())], feed_dict=feed_dict)
         yp = yp[:data_set.num_examples]
         tensor_dict = dict(zip(self.tensor_dict.keys(), vals))
         e = Evaluation(data_set.data_type, int(global_step), idxs, yp.tolist(), tensor_dict=tensor_dict)
         return e
 
+    def _get_feed_dict(self, batch):
+        return self.model.get_feed_dict(batch[1], False, supervised=False)
+
+    def get_evaluations(self, sess, batches):
+        """
+        Evaluate batch by batch, building the feed dicts ahead of time in a background thread (config.prefetch_depth)
+        """
+        batch_feed_dicts = ((batch, self._get_feed_dict(batch)) for batch in batches)
+        for batch, feed_dict in prefetch(batch_feed_dicts, self.config.prefetch_depth):
+            yield self.get_evaluation(sess, batch, feed_dict=feed_dict)
+
     def get_evaluation_from_batches(self, sess, batches):
-        e = sum(self.get_evaluation(sess, batch) for batch in batches)
-        return e
+        accumulator = EvaluationAccumulator()
+        for e in self.get_evaluations(sess, batches):
+            accumulator.add(e)
+        return accumulator.get()
 
 
 class LabeledEvaluator(Evaluator):
@@ -123,9 +207,9 @@ class LabeledEvaluator(Evaluator):
         super(LabeledEvaluator, self).__init__(config, model, tensor_dict=tensor_dict)
         self.y = model.y
 
-    def get_evaluation(self, sess, batch):
+    def get_evaluation(self, sess, batch, feed_dict=None):
         idxs, data_set = batch
-        feed_dict = self.model.get_feed_dict(data_set, False, supervised=False)
+        feed_dict = feed_dict or self._get_feed_dict(batch)
         global_step, yp, vals = sess.run([self.global_step, self.yp, list(self.tensor_dict.values())], feed_dict=feed_dict)
         yp = yp[:data_set.num_examples]
         y = feed_dict[self.y]
@@ -139,10 +223,10 @@ class AccuracyEvaluator(LabeledEvaluator):
         super(AccuracyEvaluator, self).__init__(config, model, tensor_dict=tensor_dict)
         self.loss = model.loss
 
-    def get_evaluation(self, sess, batch):
+    def get_evaluation(self, sess, batch, feed_dict=None):
         idxs, data_set = batch
         assert isinstance(data_set, DataSet)
-        feed_dict = self.model.get_feed_dict(data_set, False)
+        feed_dict = feed_dict or self._get_feed_dict(batch)
         global_step, yp, loss, vals = sess.run([self.global_step, self.yp, self.loss, list(self.tensor_dict.values())], feed_dict=feed_dict)
         y = data_set.data['y']
         yp = yp[:data_set.num_examples]
@@ -151,6 +235,9 @@ class AccuracyEvaluator(LabeledEvaluator):
         e = AccuracyEvaluation(data_set.data_type, int(global_step), idxs, yp.tolist(), y, correct, float(loss), tensor_dict=tensor_dict)
         return e
 
+    def _get_feed_dict(self, batch):
+        return self.model.get_feed_dict(batch[1], False)
+
     @staticmethod
     def compare(yi, ypi):
         for start, stop in yi:
@@ -179,27 +266,21 @@ class ForwardEvaluation(Evaluation):
         self.dict['yp2'] = yp2
         self.id2answer_dict = id2answer_dict
 
-    def __add__(self, other):
-        if other == 0:
-            return self
-        assert self.data_type == other.data_type
-        assert self.global_step == other.global_step
-        new_idxs = self.idxs + other.idxs
-        new_yp = self.yp + other.yp
-        new_yp2 = self.yp2 + other.yp2
-        new_loss = (self.loss * self.num_examples + other.loss * other.num_examples) / len(new_yp)
-        new_id2answer_dict = dict(list(self.id2answer_dict.items()) + list(other.id2answer_dict.items()))
-        new_id2score_dict = dict(list(self.id2answer_dict['scores'].items()) + list(other.id2answer_dict['scores'].items()))
-        new_id2answer_dict['scores'] = new_id2score_dict
-        if self.tensor_dict is not None:
-            new_tensor_dict = {key: np.concatenate((val, other.tensor_dict[key]), axis=0) for key, val in self.tensor_dict.items()}
-        return ForwardEvaluation(self.data_type, self.global_step, new_idxs, new_yp, new_yp2, new_loss, new_id2answer_dict, tensor_dict=new_tensor_dict)
+    @classmethod
+    def from_evaluations(cls, es):
+        e = es[0]
+        assert all(each.data_type == e.data_type and each.global_step == e.global_step for each in es)
+        return ForwardEvaluation(e.data_type, e.global_step, _concat(es, 'idxs'), _concat(es, 'yp'), _concat(es, 'yp2'),
+                                 _mean_loss(es), _merge_id2answer_dicts(es), tensor_dict=_concat_tensor_dicts(es))
 
     def __repr__(self):
         return "{} step {}: loss={:.4f}".format(self.data_type, self.global_step, self.loss)
 
 
 class F1Evaluation(AccuracyEvaluation):
+    # like the baseline additions, merged F1 evaluations do not carry tensor_dicts
+    merge_tensor_dicts = False
+
     def __init__(self, data_type, global_step, idxs, yp, yp2, y, correct, loss, f1s, id2answer_dict, tensor_dict=None):
         super(F1Evaluation, self).__init__(data_type, global_step, idxs, yp, y, correct, loss, tensor_dict=tensor_dict)
         self.yp2 = yp2
@@ -212,22 +293,13 @@ class F1Evaluation(AccuracyEvaluation):
         f1_summary = tf.Summary(value=[tf.Summary.Value(tag='{}/f1'.format(data_type), simple_value=self.f1)])
         self.summaries.append(f1_summary)
 
-    def __add__(self, other):
-        if other == 0:
-            return self
-        assert self.data_type == other.data_type
-        assert self.global_step == other.global_step
-        new_idxs = self.idxs + other.idxs
-        new_yp = self.yp + other.yp
-        new_yp2 = self.yp2 + other.yp2
-        new_y = self.y + other.y
-        new_correct = self.correct + other.correct
-        new_f1s = self.f1s + other.f1s
-        new_loss = (self.loss * self.num_examples + other.loss * other.num_examples) / len(new_correct)
-        new_id2answer_dict = dict(list(self.id2answer_dict.items()) + list(other.id2answer_dict.items()))
-        new_id2score_dict = dict(list(self.id2answer_dict['scores'].items()) + list(other.id2answer_dict['scores'].items()))
-        new_id2answer_dict['scores'] = new_id2score_dict
-        return F1Evaluation(self.data_type, self.global_step, new_idxs, new_yp, new_yp2, new_y, new_correct, new_loss, new_f1s, new_id2answer_dict)
+    @classmethod
+    def from_evaluations(cls, es):
+        e = es[0]
+        assert all(each.data_type == e.data_type and each.global_step == e.global_step for each in es)
+        return F1Evaluation(e.data_type, e.global_step, _concat(es, 'idxs'), _concat(es, 'yp'), _concat(es, 'yp2'),
+                            _concat(es, 'y'), _concat(es, 'correct'), _mean_loss(es), _concat(es, 'f1s'),
+                            _merge_id2answer_dicts(es))
 
     def __repr__(self):
         return "{} step {}: accuracy={:.4f}, f1={:.4f}, loss={:.4f}".format(self.data_type, self.global_step, self.acc, self.f1, self.loss)
@@ -239,10 +311,11 @@ class F1Evaluator(LabeledEvaluator):
         self.yp2 = model.yp2
         self.loss = model.loss
 
-    def get_evaluation(self, sess, batch):
+    def get_evaluation(self, sess, batch, feed_dict=None):
+        # fed first: with single, Model.get_feed_dict picks the sentence of each x that the split batch must show
+        feed_dict = feed_dict or self._get_feed_dict(batch)
         idxs, data_set = self._split_batch(batch)
         assert isinstance(data_set, DataSet)
-        feed_dict = self._get_feed_dict(batch)
         global_step, yp, yp2, loss, vals = sess.run([self.global_step, self.yp, self.yp2, self.loss, list(self.tensor_dict.values())], feed_dict=feed_dict)
         y = data_set.data['y']
         if self.config.squash:
@@ -268,8 +341,8 @@ class F1Evaluator(LabeledEvaluator):
                 new_y.append(new_yi)
             y = new_y
 
-        yp, yp2 = yp[:data_set.num_examples], yp2[:data_set.num_examples]
-        spans, scores = zip(*[get_best_span(ypi, yp2i) for ypi, yp2i in zip(yp, yp2)])
+        yp, yp2 = self._get_example_rows(batch, yp), self._get_example_rows(batch, yp2)
+        spans, scores = get_best_spans(yp, yp2, max_answer_len=self.config.max_answer_len or None)
 
         def _get(xi, span):
             if len(xi) <= span[0][0]:
@@ -294,14 +367,21 @@ class F1Evaluator(LabeledEvaluator):
         tensor_dict = dict(zip(self.tensor_dict.keys(), vals))
         e = F1Evaluation(data_set.data_type, int(global_step), idxs, yp.tolist(), yp2.tolist(), y,
                          correct, float(loss), f1s, id2answer_dict, tensor_dict=tensor_dict)
+        e.x_lens = self._get_x_lens(batch, feed_dict)
         return e
 
     def _split_batch(self, batch):
         return batch
 
+    def _get_x_lens(self, batch, feed_dict):
+        return _get_x_lens(self.model, feed_dict, batch[1].num_examples)
+
     def _get_feed_dict(self, batch):
         return self.model.get_feed_dict(batch[1], False)
 
+    def _get_example_rows(self, batch, array):
+        return array[:batch[1].num_examples]
+
     @staticmethod
     def compare(yi, ypi, yp2i):
         for start, stop in yi:
@@ -336,10 +416,19 @@ class MultiGPUF1Evaluator(F1Evaluator):
         super(MultiGPUF1Evaluator, self).__init__(config, models[0], tensor_dict=tensor_dict)
         self.models = models
         with tf.name_scope("eval_concat"):
-            N, M, JX = config.batch_size, config.max_num_sents, config.max_sent_size
-            self.yp = tf.concat(0, [padded_reshape(model.yp, [N, M, JX]) for model in models])
-            self.yp2 = tf.concat(0, [padded_reshape(model.yp2, [N, M, JX]) for model in models])
-            self.loss = tf.add_n([model.loss for model in models])/len(models)
+            # towers are concatenated as fed (batch_size rows each, or as many rows as examples with a token budget)
+            M, JX = config.max_num_sents, config.max_sent_size
+            self.yp = tf.concat(0, [padded_reshape(model.yp, [tf.shape(model.yp)[0], M, JX]) for model in models])
+            self.yp2 = tf.concat(0, [padded_reshape(model.yp2, [tf.shape(model.yp2)[0], M, JX]) for model in models])
+            if config.token_budget:
+                tower_sizes = [tf.cast(tf.shape(model.yp)[0], 'float') for model in models]
+                # empty towers have NaN mean losses and no weight
+                tower_losses = [tf.select(tf.greater(size, 0.0), model.loss, tf.zeros_like(model.loss))
+                                for model, size in zip(models, tower_sizes)]
+                self.loss = tf.add_n([loss * size for loss, size in zip(tower_losses, tower_sizes)]) / \
+                    tf.maximum(tf.add_n(tower_sizes), 1.0)
+            else:
+                self.loss = tf.add_n([model.loss for model in models])/len(models)
 
     def _split_batch(self, batches):
         idxs_list, data_sets = zip(*batches)
@@ -353,6 +442,18 @@ class MultiGPUF1Evaluator(F1Evaluator):
             feed_dict.update(model.get_feed_dict(data_set, False))
         return feed_dict
 
+    def _get_example_rows(self, batches, array):
+        # a tower that is not full leaves padding rows before the next tower's rows
+        rows, start = [], 0
+        for _, data_set in batches:
+            rows.extend(range(start, start + data_set.num_examples))
+            start += data_set.num_examples if self.config.token_budget else self.config.batch_size
+        return array[rows]
+
+    def _get_x_lens(self, batches, feed_dict):
+        return list(itertools.chain.from_iterable(_get_x_lens(model, feed_dict, data_set.num_examples)
+                                                  for model, (_, data_set) in zip(self.models, batches)))
+
 
 class ForwardEvaluator(Evaluator):
     def __init__(self, config, model, tensor_dict=None):
@@ -360,14 +461,14 @@ class ForwardEvaluator(Evaluator):
         self.yp2 = model.yp2
         self.loss = model.loss
 
-    def get_evaluation(self, sess, batch):
+    def get_evaluation(self, sess, batch, feed_dict=None):
         idxs, data_set = batch
         assert isinstance(data_set, DataSet)
-        feed_dict = self.model.get_feed_dict(data_set, False)
+        feed_dict = feed_dict or self._get_feed_dict(batch)
         global_step, yp, yp2, loss, vals = sess.run([self.global_step, self.yp, self.yp2, self.loss, list(self.tensor_dict.values())], feed_dict=feed_dict)
 
         yp, yp2 = yp[:data_set.num_examples], yp2[:data_set.num_examples]
-        spans, scores = zip(*[get_best_span(ypi, yp2i) for ypi, yp2i in zip(yp, yp2)])
+        spans, scores = get_best_spans(yp, yp2, max_answer_len=self.config.max_answer_len or None)
 
         def _get(xi, span):
             if len(xi) <= span[0][0]:
@@ -389,8 +490,12 @@ class ForwardEvaluator(Evaluator):
         id2answer_dict['scores'] = id2score_dict
         tensor_dict = dict(zip(self.tensor_dict.keys(), vals))
         e = ForwardEvaluation(data_set.data_type, int(global_step), idxs, yp.tolist(), yp2.tolist(), float(loss), id2answer_dict, tensor_dict=tensor_dict)
+        e.x_lens = _get_x_lens(self.model, feed_dict, data_set.num_examples)
         return e
 
+    def _get_feed_dict(self, batch):
+        return self.model.get_feed_dict(batch[1], False)
+
     @staticmethod
     def compare(yi, ypi, yp2i):
         for start, stop in yi:
@@ -2,10 +2,15 @@ import gzip
 import json
 from json import encoder
 import os
+import threading
+from queue import Queue
 
 import tensorflow as tf
+from tensorflow.python.framework import graph_util
 
 from basic.evaluator import Evaluation, F1Evaluation
+from basic.model import FROZEN_CONFIG_KEYS, FROZEN_INPUT_KEYS, FROZEN_OUTPUT_KEYS
+from my.columnar import save_ragged_dict
 from my.utils import short_floats
 
 import pickle
@@ -15,9 +20,14 @@ class GraphHandler(object):
     def __init__(self, config, model):
         self.config = config
         self.model = model
-        self.saver = tf.train.Saver(max_to_keep=config.max_to_keep)
+        # a frozen graph (see FrozenModel) has no variables to save
+        self.saver = tf.train.Saver(max_to_keep=config.max_to_keep) if len(tf.all_variables()) > 0 else None
         self.writer = None
         self.save_path = os.path.join(config.save_dir, config.model_name)
+        self.save_vars = None
+        self.save_queue = None
+        self.save_thread = None
+        self.save_error = None
 
     def initialize(self, sess):
         sess.run(tf.initialize_all_variables())
@@ -28,8 +38,75 @@ class GraphHandler(object):
             self.writer = tf.train.SummaryWriter(self.config.log_dir, graph=tf.get_default_graph())
 
     def save(self, sess, global_step=None):
-        saver = tf.train.Saver(max_to_keep=self.config.max_to_keep)
-        saver.save(sess, self.save_path, global_step=global_step)
+        if self.config.async_save:
+            self._save_async(sess, global_step=global_step)
+        else:
+            self.saver.save(sess, self.save_path, global_step=global_step)
+
+    def _save_async(self, sess, global_step=None):
+        """
+        Snapshot the variable values (the only part done on the calling thread)
+        and write them from a private graph and session in a background thread.
+        At most one snapshot waits behind the one being written.
+        A failed write is raised by the next save (or join).
+        """
+        self._raise_save_error()
+        if self.save_thread is None:
+            self._build_save_graph(sess)
+        values = sess.run(self.save_vars)
+        self.save_queue.put((values, global_step))
+
+    def _raise_save_error(self):
+        if self.save_error is not None:
+            global_step, e = self.save_error
+            self.save_error = None
+            raise RuntimeError("async save of step {} failed: {}".format(global_step, e)) from e
+
+    def _build_save_graph(self, sess):
+        self.save_vars = tf.all_variables()
+        with sess.graph.as_default():
+            # the .meta of each checkpoint is the training graph's, as with synchronous saves
+            meta_graph_def = tf.train.export_meta_graph(saver_def=self.saver.saver_def)
+        graph = tf.Graph()
+        with graph.as_default():
+            placeholders, vars_ = [], {}
+            for var in self.save_vars:
+                name = var.name.split(":")[0]
+                placeholder = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+                vars_[name] = tf.Variable(placeholder, name=name, trainable=False, collections=[])
+                placeholders.append(placeholder)
+            init_op = tf.initialize_variables(list(vars_.values()))
+            saver = tf.train.Saver(vars_, max_to_keep=self.config.max_to_keep)
+        sess = tf.Session(graph=graph)
+        self.save_queue = Queue(maxsize=1)
+
+        def _write():
+            while True:
+                item = self.save_queue.get()
+                if item is None:
+                    sess.close()
+                    return
+                values, global_step = item
+                try:
+                    sess.run(init_op, feed_dict=dict(zip(placeholders, values)))
+                    checkpoint_path = saver.save(sess, self.save_path, global_step=global_step, write_meta_graph=False)
+                    with open(checkpoint_path + ".meta", 'wb') as fh:
+                        fh.write(meta_graph_def.SerializeToString())
+                except Exception as e:
+                    self.save_error = global_step, e
+
+        self.save_thread = threading.Thread(target=_write, daemon=True)
+        self.save_thread.start()
+
+    def join(self):
+        """
+        Wait until all the pending (async) saves are written.
+        """
+        if self.save_thread is not None:
+            self.save_queue.put(None)
+            self.save_thread.join()
+            self.save_thread = None
+        self._raise_save_error()
 
     def _load(self, sess):
         config = self.config
@@ -53,6 +130,29 @@ class GraphHandler(object):
         print("Loading saved model from {}".format(save_path))
         saver.restore(sess, save_path)
 
+    def export(self, sess, path):
+        """
+        Write the inference graph of the model with its variables (as loaded) folded into constants.
+        Everything that yp, yp2 and global_step do not depend on (loss, EMA, summaries, y and y2) is pruned.
+        The tensor names and the flags the graph depends on go to path + ".json"; load it with FrozenModel.
+        """
+        model, config = self.model, self.config
+        tensors = {key: getattr(model, key) for key in FROZEN_INPUT_KEYS + FROZEN_OUTPUT_KEYS if hasattr(model, key)}
+        if not config.use_glove_for_unk:
+            del tensors['new_emb_mat']
+        graph_def = tf.get_default_graph().as_graph_def()
+        for node in graph_def.node:
+            node.device = ""
+        output_names = [tensors[key].op.name for key in FROZEN_OUTPUT_KEYS]
+        graph_def = graph_util.convert_variables_to_constants(sess, graph_def, output_names)
+        with open(path, 'wb') as fh:
+            fh.write(graph_def.SerializeToString())
+        spec = {'tensors': {key: [tensor.name, tensor.dtype.base_dtype.name] for key, tensor in tensors.items()},
+                'config': {key: getattr(config, key) for key in FROZEN_CONFIG_KEYS}}
+        with open(path + ".json", 'w') as fh:
+            json.dump(spec, fh)
+        print("Exported {} nodes to {}".format(len(graph_def.node), path))
+
     def add_summary(self, summary, global_step):
         self.writer.add_summary(summary, global_step)
 
@@ -62,7 +162,11 @@ class GraphHandler(object):
 
     def dump_eval(self, e, precision=2, path=None):
         assert isinstance(e, Evaluation)
-        if self.config.dump_pickle:
+        if self.config.dump_binary:
+            path = path or os.path.join(self.config.eval_dir, "{}-{}.bin".format(e.data_type, str(e.global_step).zfill(6)))
+            # yp and yp2 are cropped to the real sentences and tokens of each example, as fed in x_mask
+            save_ragged_dict(path, e.dict, ('yp', 'yp2'), dtype=self.config.binary_dtype, lens=e.x_lens)
+        elif self.config.dump_pickle:
             path = path or os.path.join(self.config.eval_dir, "{}-{}.pklz".format(e.data_type, str(e.global_step).zfill(6)))
             with gzip.open(path, 'wb', compresslevel=3) as fh:
                 pickle.dump(e.dict, fh)
@@ -3,20 +3,28 @@ import json
 import math
 import os
 import shutil
+import time
+from collections import defaultdict
 from pprint import pprint
 
 import tensorflow as tf
 from tqdm import tqdm
-import numpy as np
 
-from basic.evaluator import ForwardEvaluator, MultiGPUF1Evaluator
+from basic.ensemble import get_ensemble_func
+from basic.evaluator import ForwardEvaluator, MultiGPUF1Evaluator, EvaluationAccumulator
 from basic.graph_handler import GraphHandler
-from basic.model import get_multi_gpu_models
+from basic.model import get_multi_gpu_models, FrozenModel
 from basic.trainer import MultiGPUTrainer
-from basic.read_data import read_data, get_squad_data_filter, update_config
+from basic.read_data import read_data, get_squad_data_filter, update_config, index_data, DataSet, set_new_emb_mat, \
+    update_config_from_shared, get_bucketed_epoch_stats
+from basic.server import serve
+from my.utils import prefetch, get_emb_mat
 
 
 def main(config):
+    if config.token_budget > 0 and not (config.cluster and config.len_opt and config.cpu_opt):
+        # without bucketing the budget is ignored, and without len_opt and cpu_opt batches are padded to the max sizes
+        raise ValueError("token_budget requires cluster, len_opt and cpu_opt")
     set_dirs(config)
     with tf.device(config.device):
         if config.mode == 'train':
@@ -25,6 +33,14 @@ def main(config):
             _test(config)
         elif config.mode == 'forward':
             _forward(config)
+        elif config.mode == 'bench_feed':
+            _bench_feed(config)
+        elif config.mode == 'serve':
+            serve(config)
+        elif config.mode == 'ensemble':
+            _ensemble(config)
+        elif config.mode == 'export':
+            _export(config)
         else:
             raise ValueError("invalid value for 'mode': {}".format(config.mode))
 
@@ -66,15 +82,14 @@ def _train(config):
     train_data = read_data(config, 'train', config.load, data_filter=data_filter)
     dev_data = read_data(config, 'dev', True, data_filter=data_filter)
     update_config(config, [train_data, dev_data])
+    index_data(config, train_data)
+    index_data(config, dev_data)
 
     _config_debug(config)
 
     word2vec_dict = train_data.shared['lower_word2vec'] if config.lower_word else train_data.shared['word2vec']
     word2idx_dict = train_data.shared['word2idx']
-    idx2vec_dict = {word2idx_dict[word]: vec for word, vec in word2vec_dict.items() if word in word2idx_dict}
-    emb_mat = np.array([idx2vec_dict[idx] if idx in idx2vec_dict
-                        else np.random.multivariate_normal(np.zeros(config.word_emb_size), np.eye(config.word_emb_size))
-                        for idx in range(config.word_vocab_size)])
+    emb_mat = get_emb_mat(word2vec_dict, word2idx_dict, config.word_vocab_size, config.word_emb_size)
     config.emb_mat = emb_mat
 
     # construct model graph and variables (using default graph)
@@ -91,12 +106,21 @@ def _train(config):
 
     # Begin training
     num_steps = config.num_steps or int(math.ceil(train_data.num_examples / (config.batch_size * config.num_gpus))) * config.num_epochs
+    if config.cluster:
+        num_epoch_steps, padding_efficiency = get_bucketed_epoch_stats(config, train_data)
+        print("{} bucketed steps per epoch, padding efficiency: {:.1%}".format(num_epoch_steps, padding_efficiency))
+        if config.token_budget and not config.num_steps:
+            # token budget batches hold varying numbers of examples, so an epoch is counted in bucketed steps
+            num_steps = num_epoch_steps * config.num_epochs
     global_step = 0
-    for batches in tqdm(train_data.get_multi_batches(config.batch_size, config.num_gpus,
-                                                     num_steps=num_steps, shuffle=True, cluster=config.cluster), total=num_steps):
+    train_batches = train_data.get_multi_batches(config.batch_size, config.num_gpus, num_steps=num_steps, shuffle=True,
+                                                 cluster=config.cluster, token_budget=config.token_budget, squash=config.squash)
+    # feed dicts are built in a background thread while the previous step runs
+    batch_feed_dicts = prefetch(((batches, trainer.get_feed_dict(batches)) for batches in train_batches), config.prefetch_depth)
+    for batches, feed_dict in tqdm(batch_feed_dicts, total=num_steps):
         global_step = sess.run(model.global_step) + 1  # +1 because all calculations are done after step
         get_summary = global_step % config.log_period == 0
-        loss, summary, train_op = trainer.step(sess, batches, get_summary=get_summary)
+        loss, summary, train_op = trainer.step(sess, batches, get_summary=get_summary, feed_dict=feed_dict)
         if get_summary:
             graph_handler.add_summary(summary, global_step)
 
@@ -125,20 +149,18 @@ def _train(config):
                 graph_handler.dump_answer(e_dev)
     if global_step % config.save_period != 0:
         graph_handler.save(sess, global_step=global_step)
+    graph_handler.join()
 
 
 def _test(config):
     test_data = read_data(config, 'test', True)
     update_config(config, [test_data])
+    index_data(config, test_data)
 
     _config_debug(config)
 
     if config.use_glove_for_unk:
-        word2vec_dict = test_data.shared['lower_word2vec'] if config.lower_word else test_data.shared['word2vec']
-        new_word2idx_dict = test_data.shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        config.new_emb_mat = new_emb_mat
+        config.new_emb_mat = test_data.shared['new_emb_mat']
 
     pprint(config.__flags, indent=2)
     models = get_multi_gpu_models(config)
@@ -152,10 +174,9 @@ def _test(config):
     if 0 < config.test_num_batches < num_steps:
         num_steps = config.test_num_batches
 
-    e = None
-    for multi_batch in tqdm(test_data.get_multi_batches(config.batch_size, config.num_gpus, num_steps=num_steps, cluster=config.cluster), total=num_steps):
-        ei = evaluator.get_evaluation(sess, multi_batch)
-        e = ei if e is None else e + ei
+    accumulator = EvaluationAccumulator()
+    for ei in evaluator.get_evaluations(sess, tqdm(test_data.get_multi_batches(config.batch_size, config.num_gpus, num_steps=num_steps, cluster=config.cluster), total=num_steps)):
+        accumulator.add(ei)
         if config.vis:
             eval_subdir = os.path.join(config.eval_dir, "{}-{}".format(ei.data_type, str(ei.global_step).zfill(6)))
             if not os.path.exists(eval_subdir):
@@ -163,6 +184,7 @@ def _test(config):
             path = os.path.join(eval_subdir, str(ei.idxs[0]).zfill(8))
             graph_handler.dump_eval(ei, path=path)
 
+    e = accumulator.get()
     print(e)
     if config.dump_answer:
         print("dumping answer ...")
@@ -176,24 +198,28 @@ def _forward(config):
     assert config.load
     test_data = read_data(config, config.forward_name, True)
     update_config(config, [test_data])
+    if config.frozen_path:
+        FrozenModel.load_config(config, config.frozen_path)
+    index_data(config, test_data)
 
     _config_debug(config)
 
     if config.use_glove_for_unk:
-        word2vec_dict = test_data.shared['lower_word2vec'] if config.lower_word else test_data.shared['word2vec']
-        new_word2idx_dict = test_data.shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        config.new_emb_mat = new_emb_mat
+        config.new_emb_mat = test_data.shared['new_emb_mat']
 
     pprint(config.__flags, indent=2)
-    models = get_multi_gpu_models(config)
-    model = models[0]
+    if config.frozen_path:
+        # exported with --mode export: no variables to initialize or load
+        model = FrozenModel(config, config.frozen_path)
+    else:
+        models = get_multi_gpu_models(config)
+        model = models[0]
     evaluator = ForwardEvaluator(config, model)
     graph_handler = GraphHandler(config, model)  # controls all tensors and variables in the graph, including loading /saving
 
     sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
-    graph_handler.initialize(sess)
+    if not config.frozen_path:
+        graph_handler.initialize(sess)
 
     num_batches = math.ceil(test_data.num_examples / config.batch_size)
     if 0 < config.test_num_batches < num_batches:
@@ -208,6 +234,130 @@ def _forward(config):
         graph_handler.dump_eval(e, path=config.eval_path)
 
 
+def _export(config):
+    assert config.load
+    shared_path = config.shared_path or os.path.join(config.out_dir, "shared.json")
+    with open(shared_path, 'r') as fh:
+        shared = json.load(fh)
+    # sizes other than the max word size are dynamic in the graph, so the thresholds do
+    update_config_from_shared(config, shared)
+
+    pprint(config.__flags, indent=2)
+    models = get_multi_gpu_models(config)
+    model = models[0]
+    graph_handler = GraphHandler(config, model)
+    sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+    graph_handler.initialize(sess)
+    graph_handler.export(sess, config.frozen_path or os.path.join(config.save_dir, "frozen.pb"))
+
+
+def _get_ensemble_groups(config):
+    """
+    Group the checkpoints of config.load_path (comma-separated) by the content of their shared.json (config.shared_path),
+    since checkpoints with the same vocab can share one graph and the same feed dicts.
+    :return: list of (shared, [load_path, ...])
+    """
+    load_paths = config.load_path.split(",")
+    shared_paths = config.shared_path.split(",")
+    if len(shared_paths) == 1:
+        shared_paths = shared_paths * len(load_paths)
+    assert len(shared_paths) == len(load_paths), "need one shared path, or one per load path"
+    groups = []
+    for load_path, shared_path in zip(load_paths, shared_paths):
+        with open(shared_path, 'r') as fh:
+            shared = json.load(fh)
+        for each_shared, each_load_paths in groups:
+            if each_shared == shared:
+                each_load_paths.append(load_path)
+                break
+        else:
+            groups.append((shared, [load_path]))
+    return groups
+
+
+def _ensemble(config):
+    """
+    Ensemble several checkpoints in one process: the data is read once, a graph is built per distinct vocab,
+    and the checkpoints of a group are restored one after another into it, feeding the same feed dicts.
+    """
+    assert config.load
+    groups = _get_ensemble_groups(config)
+    config.shared_path = config.shared_path.split(",")[0]
+    test_data = read_data(config, config.forward_name, True)
+    _config_debug(config)
+    num_batches = math.ceil(test_data.num_examples / config.batch_size)
+    if 0 < config.test_num_batches < num_batches:
+        num_batches = config.test_num_batches
+
+    yp_lists, yp2_lists = defaultdict(list), defaultdict(list)
+    for shared, load_paths in groups:
+        test_data.shared.update(shared)
+        if config.use_glove_for_unk:
+            set_new_emb_mat(config, test_data.shared)
+        update_config(config, [test_data])
+        index_data(config, test_data)
+
+        graph = tf.Graph()
+        with graph.as_default():
+            models = get_multi_gpu_models(config)
+            model = models[0]
+            graph_handler = GraphHandler(config, model)
+            batch_feed_dicts = [(batch, model.get_feed_dict(batch[1], False, supervised=False))
+                                for batch in tqdm(test_data.get_batches(config.batch_size, num_batches=num_batches), total=num_batches)]
+            sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+            for load_path in load_paths:
+                config.load_path = load_path
+                graph_handler.initialize(sess)
+                for (idxs, data_set), feed_dict in tqdm(batch_feed_dicts):
+                    yp, yp2 = sess.run([model.yp, model.yp2], feed_dict=feed_dict)
+                    x_mask = feed_dict[model.x_mask]
+                    if config.dedup_x:
+                        x_mask = x_mask[feed_dict[model.x_idx]]
+                    for i, idx in enumerate(idxs):
+                        # crop the padding, which depends on the batch and the vocab group
+                        m, jx = max(1, x_mask[i].any(1).sum()), max(1, x_mask[i].any(0).sum())
+                        yp_lists[idx].append(yp[i, :m, :jx])
+                        yp2_lists[idx].append(yp2[i, :m, :jx])
+            sess.close()
+
+    ensemble_func = get_ensemble_func(config.ensemble_func)
+    out = {}
+    data, shared = test_data.data, test_data.shared
+    for idx in tqdm(sorted(yp_lists)):
+        rx = data['*x'][idx]
+        context, wordss = shared['p'][rx[0]][rx[1]], shared['x'][rx[0]][rx[1]]
+        out[data['ids'][idx]] = ensemble_func(context, wordss, yp_lists[idx], yp2_lists[idx])
+
+    answer_path = config.answer_path or os.path.join(config.answer_dir, "{}-ensemble.json".format(config.forward_name))
+    print("dumping answer to {} ...".format(answer_path))
+    with open(answer_path, 'w') as fh:
+        json.dump(out, fh)
+
+
+def _bench_feed(config):
+    """
+    Compare feed dict construction time per batch with and without the ids precomputed by index_data.
+    """
+    data_filter = get_squad_data_filter(config)
+    dev_data = read_data(config, 'dev', config.load, data_filter=data_filter)
+    update_config(config, [dev_data])
+    start_time = time.time()
+    index_data(config, dev_data)
+    print("index_data: {:.2f}s".format(time.time() - start_time))
+
+    models = get_multi_gpu_models(config)
+    model = models[0]
+    num_batches = config.test_num_batches or 100
+    batches = [batch for _, batch in dev_data.get_batches(config.batch_size, num_batches=num_batches, shuffle=True)]
+    str_batches = [DataSet({key: list(val) for key, val in batch.data.items() if key not in ('x_ids', 'q_ids')}, batch.data_type,
+                           shared=batch.shared) for batch in batches]
+    for name, each_batches in (('string lookup', str_batches), ('indexed', batches)):
+        start_time = time.time()
+        for batch in each_batches:
+            model.get_feed_dict(batch, True)
+        print("{}: {:.2f}ms per batch".format(name, (time.time() - start_time) * 1000 / len(each_batches)))
+
+
 def _get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("config_path")
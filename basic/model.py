@@ -1,3 +1,4 @@
+import json
 import random
 
 import itertools
@@ -6,12 +7,20 @@ import tensorflow as tf
 from tensorflow.python.ops.rnn_cell import BasicLSTMCell
 
 from basic.read_data import DataSet
-from my.tensorflow import get_initializer
-from my.tensorflow.nn import softsel, get_logits, highway_network, multi_conv1d
+from my.tensorflow import get_initializer, add_wd, exp_mask
+from my.tensorflow.nn import softsel, softmax, get_logits, highway_network, multi_conv1d
 from my.tensorflow.rnn import bidirectional_dynamic_rnn
 from my.tensorflow.rnn_cell import SwitchableDropoutWrapper, AttentionCell
 
 
+# flags that an exported graph is built with, and that get_feed_dict must agree with (see FrozenModel)
+FROZEN_CONFIG_KEYS = ('max_word_size', 'word_emb_size', 'use_glove_for_unk', 'dedup_x', 'single', 'squash')
+# of those, the flags that have already shaped the data and sizes when the graph is loaded, so they cannot be overridden
+FROZEN_DATA_KEYS = ('use_glove_for_unk', 'single', 'squash')
+FROZEN_INPUT_KEYS = ('x', 'cx', 'x_mask', 'q', 'cq', 'q_mask', 'is_train', 'new_emb_mat', 'x_idx')
+FROZEN_OUTPUT_KEYS = ('yp', 'yp2', 'global_step')
+
+
 def get_multi_gpu_models(config):
     models = []
     for gpu_idx in range(config.num_gpus):
@@ -30,8 +39,9 @@ class Model(object):
                                            initializer=tf.constant_initializer(0), trainable=False)
 
         # Define forward inputs here
+        # N is dynamic, since batches can be sized by a token budget (see DataSet.get_bucketed_groups)
         N, M, JX, JQ, VW, VC, W = \
-            config.batch_size, config.max_num_sents, config.max_sent_size, \
+            None, config.max_num_sents, config.max_sent_size, \
             config.max_ques_size, config.word_vocab_size, config.char_vocab_size, config.max_word_size
         self.x = tf.placeholder('int32', [N, None, None], name='x')
         self.cx = tf.placeholder('int32', [N, None, None, W], name='cx')
@@ -43,11 +53,15 @@ class Model(object):
         self.y2 = tf.placeholder('bool', [N, None, None], name='y2')
         self.is_train = tf.placeholder('bool', [], name='is_train')
         self.new_emb_mat = tf.placeholder('float', [None, config.word_emb_size], name='new_emb_mat')
+        if config.dedup_x:
+            # x, cx and x_mask then hold the distinct paragraphs of the batch, and x_idx the paragraph of each question
+            self.x_idx = tf.placeholder('int32', [N], name='x_idx')
 
         # Define misc
         self.tensor_dict = {}
 
         # Forward outputs / loss inputs
+        self.h = None
         self.logits = None
         self.yp = None
         self.var_list = None
@@ -147,18 +161,27 @@ class Model(object):
             else:
                 (fw_h, bw_h), _ = bidirectional_dynamic_rnn(cell, cell, xx, x_len, dtype='float', scope='h1')  # [N, M, JX, 2d]
                 h = tf.concat(3, [fw_h, bw_h])  # [N, M, JX, 2d]
+            self.h = h  # context encoding, which can be fed directly (see basic.server)
+
+            if config.dedup_x:
+                # each paragraph is encoded once above, and its encoding is shared by its questions from here on
+                h = tf.gather(h, self.x_idx)
+                x_len = tf.gather(x_len, self.x_idx)
+                x_mask = tf.gather(self.x_mask, self.x_idx)
+            else:
+                x_mask = self.x_mask
             self.tensor_dict['u'] = u
             self.tensor_dict['h'] = h
 
         with tf.variable_scope("main"):
             if config.dynamic_att:
                 p0 = h
-                u = tf.reshape(tf.tile(tf.expand_dims(u, 1), [1, M, 1, 1]), [N * M, JQ, 2 * d])
-                q_mask = tf.reshape(tf.tile(tf.expand_dims(self.q_mask, 1), [1, M, 1]), [N * M, JQ])
+                u = tf.reshape(tf.tile(tf.expand_dims(u, 1), [1, M, 1, 1]), [-1, JQ, 2 * d])
+                q_mask = tf.reshape(tf.tile(tf.expand_dims(self.q_mask, 1), [1, M, 1]), [-1, JQ])
                 first_cell = AttentionCell(cell, u, mask=q_mask, mapper='sim',
                                            input_keep_prob=self.config.input_keep_prob, is_train=self.is_train)
             else:
-                p0 = attention_layer(config, self.is_train, h, u, h_mask=self.x_mask, u_mask=self.q_mask, scope="p0", tensor_dict=self.tensor_dict)
+                p0 = attention_layer(config, self.is_train, h, u, h_mask=x_mask, u_mask=self.q_mask, scope="p0", tensor_dict=self.tensor_dict)
                 first_cell = d_cell
 
             (fw_g0, bw_g0), _ = bidirectional_dynamic_rnn(first_cell, first_cell, p0, x_len, dtype='float', scope='g0')  # [N, M, JX, 2d]
@@ -167,15 +190,15 @@ class Model(object):
             g1 = tf.concat(3, [fw_g1, bw_g1])
 
             logits = get_logits([g1, p0], d, True, wd=config.wd, input_keep_prob=config.input_keep_prob,
-                                mask=self.x_mask, is_train=self.is_train, func=config.answer_func, scope='logits1')
-            a1i = softsel(tf.reshape(g1, [N, M * JX, 2 * d]), tf.reshape(logits, [N, M * JX]))
+                                mask=x_mask, is_train=self.is_train, func=config.answer_func, scope='logits1')
+            a1i = softsel(tf.reshape(g1, [-1, M * JX, 2 * d]), tf.reshape(logits, [-1, M * JX]))
             a1i = tf.tile(tf.expand_dims(tf.expand_dims(a1i, 1), 1), [1, M, JX, 1])
 
             (fw_g2, bw_g2), _ = bidirectional_dynamic_rnn(d_cell, d_cell, tf.concat(3, [p0, g1, a1i, g1 * a1i]),
                                                           x_len, dtype='float', scope='g2')  # [N, M, JX, 2d]
             g2 = tf.concat(3, [fw_g2, bw_g2])
             logits2 = get_logits([g2, p0], d, True, wd=config.wd, input_keep_prob=config.input_keep_prob,
-                                 mask=self.x_mask,
+                                 mask=x_mask,
                                  is_train=self.is_train, func=config.answer_func, scope='logits2')
 
             flat_logits = tf.reshape(logits, [-1, M * JX])
@@ -248,35 +271,53 @@ class Model(object):
         N, M, JX, JQ, VW, VC, d, W = \
             config.batch_size, config.max_num_sents, config.max_sent_size, \
             config.max_ques_size, config.word_vocab_size, config.char_vocab_size, config.hidden_size, config.max_word_size
+        if config.token_budget:
+            # batches of a token budget are not padded to batch_size
+            N = batch.num_examples
         feed_dict = {}
+        # ids precomputed by read_data.index_data; otherwise words are looked up one by one
+        indexed = 'x_ids' in batch.data
 
         if config.len_opt:
             """
             Note that this optimization results in variable GPU RAM usage (i.e. can cause OOM in the middle of training.)
             First test without len_opt and make sure no OOM, and use len_opt
             """
-            if sum(len(sent) for para in batch.data['x'] for sent in para) == 0:
+            if indexed:
+                new_JX = max([1] + [ids.shape[1] for ids in batch.data['x_ids']])
+            elif sum(len(sent) for para in batch.data['x'] for sent in para) == 0:
                 new_JX = 1
             else:
                 new_JX = max(len(sent) for para in batch.data['x'] for sent in para)
             JX = min(JX, new_JX)
 
-            if sum(len(ques) for ques in batch.data['q']) == 0:
+            if indexed:
+                new_JQ = max([1] + [len(ids) for ids in batch.data['q_ids']])
+            elif sum(len(ques) for ques in batch.data['q']) == 0:
                 new_JQ = 1
             else:
                 new_JQ = max(len(ques) for ques in batch.data['q'])
             JQ = min(JQ, new_JQ)
 
         if config.cpu_opt:
-            if sum(len(para) for para in batch.data['x']) == 0:
+            if indexed:
+                new_M = max([1] + [ids.shape[0] for ids in batch.data['x_ids']])
+            elif sum(len(para) for para in batch.data['x']) == 0:
                 new_M = 1
             else:
                 new_M = max(len(para) for para in batch.data['x'])
             M = min(M, new_M)
 
-        x = np.zeros([N, M, JX], dtype='int32')
-        cx = np.zeros([N, M, JX, W], dtype='int32')
-        x_mask = np.zeros([N, M, JX], dtype='bool')
+        if config.dedup_x:
+            # not while training or with single, where the fed sentence depends on the question's answer
+            x_examples, x_idx, NX = _get_x_rows(batch, N, not is_train and not config.single)
+            feed_dict[self.x_idx] = x_idx
+        else:
+            x_examples, NX = range(batch.num_examples), N
+
+        x = np.zeros([NX, M, JX], dtype='int32')
+        cx = np.zeros([NX, M, JX, W], dtype='int32')
+        x_mask = np.zeros([NX, M, JX], dtype='bool')
         q = np.zeros([N, JQ], dtype='int32')
         cq = np.zeros([N, JQ, W], dtype='int32')
         q_mask = np.zeros([N, JQ], dtype='bool')
@@ -292,7 +333,7 @@ class Model(object):
             feed_dict[self.new_emb_mat] = batch.shared['new_emb_mat']
 
         X = batch.data['x']
-        CX = batch.data['cx']
+        single_sent_idxs = {}
 
         if supervised:
             y = np.zeros([N, M, JX], dtype='bool')
@@ -300,13 +341,13 @@ class Model(object):
             feed_dict[self.y] = y
             feed_dict[self.y2] = y2
 
-            for i, (xi, cxi, yi) in enumerate(zip(X, CX, batch.data['y'])):
+            for i, (xi, yi) in enumerate(zip(X, batch.data['y'])):
                 start_idx, stop_idx = random.choice(yi)
                 j, k = start_idx
                 j2, k2 = stop_idx
                 if config.single:
                     X[i] = [xi[j]]
-                    CX[i] = [cxi[j]]
+                    single_sent_idxs[i] = j
                     j, j2 = 0, 0
                 if config.squash:
                     offset = sum(map(len, xi[:j]))
@@ -316,6 +357,28 @@ class Model(object):
                 y[i, j, k] = True
                 y2[i, j2, k2-1] = True
 
+        if indexed:
+            token2word, token2chars = batch.shared['token2word'], batch.shared['token2chars']
+            X_ids = batch.data['x_ids']
+            for i, ei in enumerate(x_examples):
+                ids = X_ids[ei]
+                if i in single_sent_idxs:
+                    ids = ids[single_sent_idxs[i]:single_sent_idxs[i] + 1]
+                if config.squash:
+                    ids = ids[ids > 0][None]
+                ids = ids[:M, :JX]
+                m, jx = ids.shape
+                x[i, :m, :jx] = token2word[ids]
+                cx[i, :m, :jx] = token2chars[ids]
+                x_mask[i, :m, :jx] = ids > 0
+
+            for i, ids in enumerate(batch.data['q_ids']):
+                ids = ids[:JQ]
+                q[i, :len(ids)] = token2word[ids]
+                cq[i, :len(ids)] = token2chars[ids]
+                q_mask[i, :len(ids)] = True
+            return feed_dict
+
         def _get_word(word):
             d = batch.shared['word2idx']
             for each in (word, word.lower(), word.capitalize(), word.upper()):
@@ -334,7 +397,18 @@ class Model(object):
                 return d[char]
             return 1
 
-        for i, xi in enumerate(X):
+        def _get_chars(word):
+            # (word, max_word_size) -> char ids table, filled lazily instead of storing cx and cq;
+            # keyed by the cut as well, since shared can be fed to models with different max_word_size.
+            # Only single dict gets and sets are used, so the prefetch thread at worst computes an entry twice.
+            d = batch.shared.setdefault('word2char_ids', {})
+            key = word, W
+            if key not in d:
+                d[key] = [_get_char(char) for char in word[:W]]
+            return d[key]
+
+        for i, ei in enumerate(x_examples):
+            xi = X[ei]
             if self.config.squash:
                 xi = [list(itertools.chain(*xi))]
             for j, xij in enumerate(xi):
@@ -347,41 +421,138 @@ class Model(object):
                     assert isinstance(each, int), each
                     x[i, j, k] = each
                     x_mask[i, j, k] = True
-
-        for i, cxi in enumerate(CX):
-            if self.config.squash:
-                cxi = [list(itertools.chain(*cxi))]
-            for j, cxij in enumerate(cxi):
-                if j == config.max_num_sents:
-                    break
-                for k, cxijk in enumerate(cxij):
-                    if k == config.max_sent_size:
-                        break
-                    for l, cxijkl in enumerate(cxijk):
-                        if l == config.max_word_size:
-                            break
-                        cx[i, j, k, l] = _get_char(cxijkl)
+                    chars = _get_chars(xijk)
+                    cx[i, j, k, :len(chars)] = chars
 
         for i, qi in enumerate(batch.data['q']):
             for j, qij in enumerate(qi):
                 q[i, j] = _get_word(qij)
                 q_mask[i, j] = True
-
-        for i, cqi in enumerate(batch.data['cq']):
-            for j, cqij in enumerate(cqi):
-                for k, cqijk in enumerate(cqij):
-                    cq[i, j, k] = _get_char(cqijk)
-                    if k + 1 == config.max_word_size:
-                        break
+                chars = _get_chars(qij)
+                cq[i, j, :len(chars)] = chars
 
         return feed_dict
 
 
+class FrozenModel(object):
+    """
+    Inference-only stand-in for Model, backed by a graph exported with --mode export (see GraphHandler.export):
+    the variables are constants (the EMA values with load_ema) and the loss, EMA and summary ops are pruned.
+    It has what get_feed_dict and ForwardEvaluator use, with a loss of 0 since labels are not fed.
+    """
+    def __init__(self, config, path):
+        self.config = config
+        with open(path + ".json", 'r') as fh:
+            spec = json.load(fh)
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as fh:
+            graph_def.ParseFromString(fh.read())
+        node_names = set(node.name for node in graph_def.node)
+        keys = [key for key, (name, _) in spec['tensors'].items() if name.split(":")[0] in node_names]
+        tensors = tf.import_graph_def(graph_def, return_elements=[spec['tensors'][key][0] for key in keys], name="frozen")
+        for key, tensor in zip(keys, tensors):
+            self.__setattr__(key, tensor)
+        for key, (_, dtype) in spec['tensors'].items():
+            if key not in keys:
+                # pruned (unused) inputs, e.g. cx without use_char_emb; they can still be fed
+                self.__setattr__(key, tf.placeholder(dtype, name=key))
+        self.loss = tf.constant(0.0)
+        self.tensor_dict = {}
+
+    @staticmethod
+    def load_config(config, path):
+        """
+        Set the flags of FROZEN_CONFIG_KEYS to the ones the graph at path was exported with, printing each override.
+        The flags of FROZEN_DATA_KEYS must be given as exported; a conflict raises ValueError.
+        Call after update_config, since it overrides max_word_size.
+        """
+        with open(path + ".json", 'r') as fh:
+            spec = json.load(fh)
+        for key, val in spec['config'].items():
+            given = getattr(config, key)
+            if given == val:
+                continue
+            if key in FROZEN_DATA_KEYS:
+                raise ValueError("{} was exported with {}={}, but {} was given".format(path, key, val, given))
+            print("{}: {}={} overridden by the exported {}".format(path, key, given, val))
+            config.__setattr__(key, val)
+
+    def get_feed_dict(self, batch, is_train, supervised=True):
+        assert not is_train
+        return Model.get_feed_dict(self, batch, False, supervised=False)
+
+
+def _get_x_rows(batch, N, dedup):
+    """
+    Rows of x for Model.get_feed_dict when config.dedup_x is on.
+    With dedup, questions referring to the same paragraph (same '*x') share one row.
+    :param batch:
+    :param N: number of (padded) questions
+    :param dedup:
+    :return: (the example whose paragraph fills each row, the row of each question as an int32 array of size N, number of rows)
+    """
+    x_idx = np.zeros([N], dtype='int32')
+    if not dedup or '*x' not in batch.data:
+        x_idx[:] = np.arange(N)
+        return range(batch.num_examples), x_idx, N
+    x_examples, rows = [], {}
+    for i, rx in enumerate(batch.data['*x']):
+        rx = tuple(rx)
+        if rx not in rows:
+            rows[rx] = len(x_examples)
+            x_examples.append(i)
+        x_idx[i] = rows[rx]
+    return x_examples, x_idx, max(1, len(x_examples))
+
+
+def lean_bi_attention_logits(config, h, u, h_mask=None, u_mask=None, scope=None):
+    """
+    The u_logits of bi_attention for logit_func linear, tri_linear or dot, with the same variables,
+    but without tiling h and u to [N, M, JX, JQ, 2d]: the projections of h and u are taken separately
+    and combined by broadcasting, and the h-u interaction is a batched matmul.
+    :return: [N, M, JX, JQ]
+    """
+    assert config.logit_func in ('linear', 'tri_linear', 'dot'), config.logit_func
+    with tf.variable_scope(scope or "u_logits"):
+        N, M, JX, JQ = tf.shape(h)[0], tf.shape(h)[1], tf.shape(h)[2], tf.shape(u)[1]
+        d = h.get_shape().as_list()[-1]
+        if config.logit_func == 'dot':
+            logits = tf.reshape(tf.batch_matmul(tf.reshape(h, [N, M * JX, d]), u, adj_y=True), [N, M, JX, JQ])
+        else:
+            # the matrix of linear([h_aug, u_aug(, h_aug * u_aug)]), split by argument
+            num_args = 3 if config.logit_func == 'tri_linear' else 2
+            with tf.variable_scope("first"):
+                matrix = tf.get_variable("Matrix", [num_args * d, 1], dtype='float')
+                bias = tf.get_variable("Bias", [1], dtype='float', initializer=tf.constant_initializer(0.0))
+            h_part = tf.reshape(tf.matmul(tf.reshape(h, [-1, d]), matrix[:d]), [N, M, JX, 1])
+            u_part = tf.reshape(tf.matmul(tf.reshape(u, [-1, d]), matrix[d:2 * d]), [N, 1, 1, JQ])
+            logits = h_part + u_part + bias
+            if num_args == 3:
+                hw = h * tf.reshape(matrix[2 * d:], [d])
+                logits += tf.reshape(tf.batch_matmul(tf.reshape(hw, [N, M * JX, d]), u, adj_y=True), [N, M, JX, JQ])
+            if config.wd:
+                add_wd(config.wd)
+        if h_mask is not None:
+            hu_mask = tf.expand_dims(tf.cast(h_mask, 'float'), 3) * tf.expand_dims(tf.expand_dims(tf.cast(u_mask, 'float'), 1), 1)
+            logits = exp_mask(logits, hu_mask)
+        return logits
+
+
 def bi_attention(config, is_train, h, u, h_mask=None, u_mask=None, scope=None, tensor_dict=None):
     with tf.variable_scope(scope or "bi_attention"):
         JX = tf.shape(h)[2]
         M = tf.shape(h)[1]
         JQ = tf.shape(u)[1]
+        if config.lean_att:
+            N, d = tf.shape(h)[0], h.get_shape().as_list()[-1]
+            u_logits = lean_bi_attention_logits(config, h, u, h_mask=h_mask, u_mask=u_mask, scope='u_logits')  # [N, M, JX, JQ]
+            a_u = tf.reshape(softmax(u_logits), [N, M * JX, JQ])
+            u_a = tf.reshape(tf.batch_matmul(a_u, u), [N, M, JX, d])  # [N, M, JX, d]
+            h_a = softsel(h, tf.reduce_max(u_logits, 3))  # [N, M, d]
+            h_a = tf.expand_dims(h_a, 2)  # [N, M, 1, d], broadcast over JX by attention_layer
+            _add_attention_tensors(u_logits, tensor_dict)
+            return u_a, h_a
+
         h_aug = tf.tile(tf.expand_dims(h, 3), [1, 1, 1, JQ, 1])
         u_aug = tf.tile(tf.expand_dims(tf.expand_dims(u, 1), 1), [1, M, JX, 1, 1])
         if h_mask is None:
@@ -396,19 +567,22 @@ def bi_attention(config, is_train, h, u, h_mask=None, u_mask=None, scope=None, t
         u_a = softsel(u_aug, u_logits)  # [N, M, JX, d]
         h_a = softsel(h, tf.reduce_max(u_logits, 3))  # [N, M, d]
         h_a = tf.tile(tf.expand_dims(h_a, 2), [1, 1, JX, 1])
-
-        if tensor_dict is not None:
-            a_u = tf.nn.softmax(u_logits)  # [N, M, JX, JQ]
-            a_h = tf.nn.softmax(tf.reduce_max(u_logits, 3))
-            tensor_dict['a_u'] = a_u
-            tensor_dict['a_h'] = a_h
-            variables = tf.get_collection(tf.GraphKeys.VARIABLES, scope=tf.get_variable_scope().name)
-            for var in variables:
-                tensor_dict[var.name] = var
+        _add_attention_tensors(u_logits, tensor_dict)
 
         return u_a, h_a
 
 
+def _add_attention_tensors(u_logits, tensor_dict):
+    if tensor_dict is not None:
+        a_u = tf.nn.softmax(u_logits)  # [N, M, JX, JQ]
+        a_h = tf.nn.softmax(tf.reduce_max(u_logits, 3))
+        tensor_dict['a_u'] = a_u
+        tensor_dict['a_h'] = a_h
+        variables = tf.get_collection(tf.GraphKeys.VARIABLES, scope=tf.get_variable_scope().name)
+        for var in variables:
+            tensor_dict[var.name] = var
+
+
 def attention_layer(config, is_train, h, u, h_mask=None, u_mask=None, scope=None, tensor_dict=None):
     with tf.variable_scope(scope or "attention_layer"):
         JX = tf.shape(h)[2]
@@ -4,11 +4,14 @@ import random
 import itertools
 import math
 from collections import defaultdict
+from collections.abc import Mapping
 
 import numpy as np
 
+from my.columnar import load_columnar, NestedArray
 from my.tensorflow import grouper
-from my.utils import index
+from my.utils import index, get_emb_mat
+from squad.utils import get_length_stats
 
 
 class Data(object):
@@ -38,6 +41,51 @@ class Data(object):
         raise NotImplementedError()
 
 
+class DataView(Mapping):
+    """
+    Read-only batch of a DataSet with dict data, held as an array of example idxs into the source DataSet.
+    Columns are gathered on first access, and so are the shared values that '*' keys refer to (under the key without '*'),
+    e.g. view['x'] for '*x'. Views of views and sums of views of the same source stay views
+    (sums keep the columns their views have gathered).
+    """
+    def __init__(self, source, idxs):
+        self.source = source
+        self.idxs = np.asarray(idxs, dtype='int64').reshape([-1])
+        self._cache = {}
+
+    def _get_keys(self):
+        keys = list(self.source.data.keys())
+        return keys + [key[1:] for key in keys if key.startswith('*') and key[1:] not in self.source.data]
+
+    def __getitem__(self, key):
+        if key not in self._cache:
+            self._cache[key] = self.source.gather(key, self.idxs)
+        return self._cache[key]
+
+    def __contains__(self, key):
+        return key in self.source.data or ('*' + key) in self.source.data
+
+    def __iter__(self):
+        return iter(self._get_keys())
+
+    def __len__(self):
+        return len(self._get_keys())
+
+    def get_size(self):
+        return len(self.idxs)
+
+    def take(self, positions):
+        return DataView(self.source, self.idxs[np.asarray(positions, dtype='int64')])
+
+    def __add__(self, other):
+        assert other.source is self.source
+        view = DataView(self.source, np.concatenate([self.idxs, other.idxs]))
+        # gathered columns may have been changed in place (e.g. x by Model.get_feed_dict with single), so they are carried over
+        for key in set(self._cache) | set(other._cache):
+            view._cache[key] = list(self[key]) + list(other[key])
+        return view
+
+
 class DataSet(object):
     def __init__(self, data, data_type, shared=None, valid_idxs=None):
         self.data = data  # e.g. {'X': [0, 1, 2], 'Y': [2, 3, 4]}
@@ -46,21 +94,17 @@ class DataSet(object):
         total_num_examples = self.get_data_size()
         self.valid_idxs = range(total_num_examples) if valid_idxs is None else valid_idxs
         self.num_examples = len(self.valid_idxs)
-
-    def _sort_key(self, idx):
-        rx = self.data['*x'][idx]
-        x = self.shared['x'][rx[0]][rx[1]]
-        return max(map(len, x))
+        self._columns = {}
 
     def get_data_size(self):
         if isinstance(self.data, dict):
             return len(next(iter(self.data.values())))
-        elif isinstance(self.data, Data):
+        elif isinstance(self.data, (Data, DataView)):
             return self.data.get_size()
         raise Exception()
 
     def get_by_idxs(self, idxs):
-        if isinstance(self.data, dict):
+        if isinstance(self.data, (dict, DataView)):
             out = defaultdict(list)
             for key, val in self.data.items():
                 out[key].extend(val[idx] for idx in idxs)
@@ -69,57 +113,215 @@ class DataSet(object):
             return self.data.get_by_idxs(idxs)
         raise Exception()
 
-    def get_batches(self, batch_size, num_batches=None, shuffle=False, cluster=False):
+    def _get_column(self, key, val):
+        """
+        data[key] as an array, built once: an int array for '*' references, an object array for other lists.
+        Other sequences (e.g. memory-mapped columns) are returned as is.
+        """
+        if key not in self._columns or self._columns[key][0] is not val:
+            column = val
+            if key.startswith('*') and isinstance(val, list):
+                column = np.array(val, dtype='int64') if len(val) > 0 else np.zeros([0, 0], dtype='int64')
+            elif isinstance(val, list):
+                column = np.empty([len(val)], dtype=object)
+                for i, each in enumerate(val):
+                    column[i] = each
+            self._columns[key] = val, column
+        return self._columns[key][1]
+
+    def _get_shared_column(self, key):
+        """
+        shared[key] flattened to an object array of its [article][paragraph] items, plus the offset of each article.
+        """
+        val = self.shared[key]
+        if key not in self._columns or self._columns[key][0] is not val:
+            offsets = np.zeros([len(val) + 1], dtype='int64')
+            offsets[1:] = np.cumsum([len(article) for article in val])
+            column = np.empty([offsets[-1]], dtype=object)
+            for i, item in enumerate(itertools.chain.from_iterable(val)):
+                column[i] = item
+            self._columns[key] = val, (column, offsets)
+        return self._columns[key][1]
+
+    def gather(self, key, idxs):
+        """
+        The values of data[key] at example idxs, resolving '*' references into shared if key is the referred key.
+        :param key: e.g. 'q', '*x' or 'x'
+        :param idxs: int array
+        :return: list
+        """
+        if key in self.data:
+            column = self._get_column(key, self.data[key])
+            if isinstance(column, np.ndarray):
+                return column[idxs].tolist()
+            return [column[idx] for idx in idxs]
+        ref_key = '*' + key
+        if ref_key not in self.data:
+            raise KeyError(key)
+        refs = self._get_column(ref_key, self.data[ref_key])
+        refs = refs[idxs] if isinstance(refs, np.ndarray) else [refs[idx] for idx in idxs]
+        if isinstance(self.shared[key], list) and isinstance(refs, np.ndarray) and refs.shape[1] == 2:
+            column, offsets = self._get_shared_column(key)
+            return column[offsets[refs[:, 0]] + refs[:, 1]].tolist()
+        return [index(self.shared[key], list(ref)) for ref in refs]
+
+    def _get_view(self, idxs):
+        if isinstance(self.data, DataView):
+            return self.data.take(idxs)
+        return DataView(self, idxs)
+
+    def _get_stats(self):
+        if 'stats' not in self.shared:
+            self.shared['stats'] = get_length_stats(self.data, self.shared)
+        return self.shared['stats']
+
+    def get_bucketed_groups(self, batch_size, token_budget=0, squash=False, num_groups_per_step=1, shuffle=True):
+        """
+        One shuffled epoch of batches of examples with similar (paragraph length, question length).
+        Examples are sorted by length (ties in random order) and cut into batches, which are then shuffled.
+        :param batch_size: examples per batch, if token_budget is 0
+        :param token_budget: if positive, batches take as many examples as fit in this many padded context tokens (N x M x JX)
+        :param squash: whether contexts are fed as one sentence (for the padded size)
+        :param num_groups_per_step: runs of this many neighbouring batches are shuffled as a unit (e.g. the towers of a step);
+            a last incomplete run is dropped
+        :param shuffle: if False, ties keep their order and batches are not shuffled (e.g. to count them without drawing an epoch)
+        :return: list of tuples of idxs
+        """
+        stats = self._get_stats()
+        if shuffle:
+            idxs = np.array(random.sample(self.valid_idxs, len(self.valid_idxs)), dtype='int64')
+        else:
+            idxs = np.array(list(self.valid_idxs), dtype='int64')
+        idxs = idxs[np.lexsort((stats['ques_size'][idxs], stats['para_size'][idxs]))]
+        if token_budget <= 0:
+            groups = [tuple(idxs[i:i + batch_size].tolist()) for i in range(0, len(idxs), batch_size)]
+        else:
+            num_sents, sent_sizes = self._get_padded_dims(idxs, squash)
+            groups, group = [], []
+            max_num_sents, max_sent_size = 0, 0
+            for idx, m, jx in zip(idxs.tolist(), num_sents.tolist(), sent_sizes.tolist()):
+                new_m, new_jx = max(max_num_sents, m), max(max_sent_size, jx)
+                if len(group) > 0 and (len(group) + 1) * new_m * new_jx > token_budget:
+                    groups.append(tuple(group))
+                    group, new_m, new_jx = [], m, jx
+                group.append(idx)
+                max_num_sents, max_sent_size = new_m, new_jx
+            if len(group) > 0:
+                groups.append(tuple(group))
+        if num_groups_per_step > 1:
+            # towers of a step get neighbouring batches, so they have about the same padded size and number of tokens
+            steps = [groups[i:i + num_groups_per_step] for i in range(0, len(groups), num_groups_per_step)]
+            if len(steps) > 1 and len(steps[-1]) < num_groups_per_step:
+                steps.pop()
+            if shuffle:
+                random.shuffle(steps)
+            return list(itertools.chain.from_iterable(steps))
+        if shuffle:
+            random.shuffle(groups)
+        return groups
+
+    def _get_padded_dims(self, idxs, squash=False):
+        stats = self._get_stats()
+        if squash:
+            return np.ones_like(idxs), stats['para_size'][idxs]
+        return stats['num_sents'][idxs], stats['max_sent_size'][idxs]
+
+    def get_padding_efficiency(self, groups, squash=False, batch_size=None, max_num_sents=None, max_sent_size=None):
+        """
+        Fraction of the padded context tokens (N x M x JX per batch) that are real tokens.
+        :param batch_size: N of every batch, or None if batches are not padded to a batch size (token budget)
+        :param max_num_sents: M of every batch, or None if each batch is padded to its own (cpu_opt)
+        :param max_sent_size: JX of every batch, or None if each batch is padded to its own (len_opt)
+        """
+        stats = self._get_stats()
+        real, padded = 0, 0
+        for group in groups:
+            if len(group) == 0:
+                continue
+            idxs = np.array(group, dtype='int64')
+            num_sents, sent_sizes = self._get_padded_dims(idxs, squash)
+            real += int(stats['para_size'][idxs].sum())
+            padded += (batch_size or len(idxs)) * (max_num_sents or int(num_sents.max())) * \
+                (max_sent_size or int(sent_sizes.max()))
+        return real / max(padded, 1)
+
+    def get_batches(self, batch_size, num_batches=None, shuffle=False, cluster=False, token_budget=0, squash=False,
+                    num_batches_per_step=1):
         """
 
         :param batch_size:
         :param num_batches:
         :param shuffle:
-        :param cluster: cluster examples by their lengths; this might give performance boost (i.e. faster training).
+        :param cluster: bucket examples by their lengths (see get_bucketed_groups) when shuffling; this gives faster training.
+        :param token_budget: with cluster, size batches by padded context tokens instead of batch_size
+        :param squash:
+        :param num_batches_per_step: with cluster, consecutive batches of this many come from neighbouring buckets
         :return:
         """
         num_batches_per_epoch = int(math.ceil(self.num_examples / batch_size))
-        if num_batches is None:
-            num_batches = num_batches_per_epoch
-        num_epochs = int(math.ceil(num_batches / num_batches_per_epoch))
 
-        if shuffle:
-            random_idxs = random.sample(self.valid_idxs, len(self.valid_idxs))
-            if cluster:
-                sorted_idxs = sorted(random_idxs, key=self._sort_key)
-                sorted_grouped = lambda: list(grouper(sorted_idxs, batch_size))
-                grouped = lambda: random.sample(sorted_grouped(), num_batches_per_epoch)
-            else:
+        if shuffle and cluster:
+            # with a token budget the number of batches per epoch depends on the bucketing, so epochs are drawn lazily
+            get_groups = lambda: self.get_bucketed_groups(batch_size, token_budget=token_budget, squash=squash,
+                                                          num_groups_per_step=num_batches_per_step)
+            groups = get_groups()
+            if num_batches is None:
+                num_batches = len(groups)
+            epochs = itertools.chain([groups], (get_groups() for _ in itertools.count()))
+            batch_idx_tuples = itertools.chain.from_iterable(epochs)
+        else:
+            if num_batches is None:
+                num_batches = num_batches_per_epoch
+            num_epochs = int(math.ceil(num_batches / num_batches_per_epoch))
+
+            if shuffle:
+                random_idxs = random.sample(self.valid_idxs, len(self.valid_idxs))
                 random_grouped = lambda: list(grouper(random_idxs, batch_size))
                 grouped = random_grouped
-        else:
-            raw_grouped = lambda: list(grouper(self.valid_idxs, batch_size))
-            grouped = raw_grouped
+            else:
+                raw_grouped = lambda: list(grouper(self.valid_idxs, batch_size))
+                grouped = raw_grouped
+
+            batch_idx_tuples = itertools.chain.from_iterable(grouped() for _ in range(num_epochs))
 
-        batch_idx_tuples = itertools.chain.from_iterable(grouped() for _ in range(num_epochs))
         for _ in range(num_batches):
             batch_idxs = tuple(i for i in next(batch_idx_tuples) if i is not None)
-            batch_data = self.get_by_idxs(batch_idxs)
-            shared_batch_data = {}
-            for key, val in batch_data.items():
-                if key.startswith('*'):
-                    assert self.shared is not None
-                    shared_key = key[1:]
-                    shared_batch_data[shared_key] = [index(self.shared[shared_key], each) for each in val]
-            batch_data.update(shared_batch_data)
+            if isinstance(self.data, Data):
+                batch_data = self.get_by_idxs(batch_idxs)
+                shared_batch_data = {}
+                for key, val in batch_data.items():
+                    if key.startswith('*'):
+                        assert self.shared is not None
+                        shared_key = key[1:]
+                        shared_batch_data[shared_key] = [index(self.shared[shared_key], each) for each in val]
+                batch_data.update(shared_batch_data)
+            else:
+                # a view: columns (and shared references) are gathered when the batch is fed
+                batch_data = self._get_view(batch_idxs)
 
             batch_ds = DataSet(batch_data, self.data_type, shared=self.shared)
             yield batch_idxs, batch_ds
 
-    def get_multi_batches(self, batch_size, num_batches_per_step, num_steps=None, shuffle=False, cluster=False):
+    def get_multi_batches(self, batch_size, num_batches_per_step, num_steps=None, shuffle=False, cluster=False,
+                          token_budget=0, squash=False):
+        if shuffle and cluster and token_budget > 0:
+            # every tower gets its own batch of token_budget padded tokens, rather than an even share of one large batch,
+            # so the towers of a step do about the same amount of work
+            num_batches = None if num_steps is None else num_steps * num_batches_per_step
+            batches = self.get_batches(batch_size, num_batches=num_batches, shuffle=shuffle, cluster=cluster,
+                                       token_budget=token_budget, squash=squash, num_batches_per_step=num_batches_per_step)
+            return zip(*[batches] * num_batches_per_step)
         batch_size_per_step = batch_size * num_batches_per_step
         batches = self.get_batches(batch_size_per_step, num_batches=num_steps, shuffle=shuffle, cluster=cluster)
-        multi_batches = (tuple(zip(grouper(idxs, batch_size, shorten=True, num_groups=num_batches_per_step),
+        # idxs are split the same way as divide splits the data (the last batch may be short)
+        multi_batches = (tuple(zip(grouper(idxs, int(math.ceil(len(idxs) / num_batches_per_step)), shorten=True, num_groups=num_batches_per_step),
                          data_set.divide(num_batches_per_step))) for idxs, data_set in batches)
         return multi_batches
 
     def get_empty(self):
-        if isinstance(self.data, dict):
+        if isinstance(self.data, DataView):
+            data = self._get_view([])
+        elif isinstance(self.data, dict):
             data = {key: [] for key in self.data}
         elif isinstance(self.data, Data):
             data = self.data.get_empty()
@@ -128,8 +330,10 @@ class DataSet(object):
         return DataSet(data, self.data_type, shared=self.shared)
 
     def __add__(self, other):
-        if isinstance(self.data, dict):
-            data = {key: val + other.data[key] for key, val in self.data.items()}
+        if isinstance(self.data, DataView) and isinstance(other.data, DataView) and self.data.source is other.data.source:
+            data = self.data + other.data
+        elif isinstance(self.data, (dict, DataView)):
+            data = {key: list(val) + list(other.data[key]) for key, val in self.data.items()}
         elif isinstance(self.data, Data):
             data = self.data + other.data
         else:
@@ -141,7 +345,10 @@ class DataSet(object):
     def divide(self, integer):
         batch_size = int(math.ceil(self.num_examples / integer))
         idxs_gen = grouper(self.valid_idxs, batch_size, shorten=True, num_groups=integer)
-        data_gen = (self.get_by_idxs(idxs) for idxs in idxs_gen)
+        if isinstance(self.data, Data):
+            data_gen = (self.get_by_idxs(idxs) for idxs in idxs_gen)
+        else:
+            data_gen = (self._get_view(list(idxs)) for idxs in idxs_gen)
         ds_tuple = tuple(DataSet(data, self.data_type, shared=self.shared) for data in data_gen)
         return ds_tuple
 
@@ -162,18 +369,33 @@ def read_data(config, data_type, ref, data_filter=None):
         data = json.load(fh)
     with open(shared_path, 'r') as fh:
         shared = json.load(fh)
+    if config.columnar:
+        columns = load_columnar(os.path.join(config.data_dir, "columnar_{}".format(data_type)))
+        data['q'] = columns['q']
+        shared['x'] = columns['x']
+    # characters are derived from x and q in Model.get_feed_dict, so cx and cq are not kept in memory
+    for key in ('cq', '*cx'):
+        data.pop(key, None)
+    shared.pop('cx', None)
+
+    # per-example length statistics, computed by squad.prepro (or here for older data)
+    stats_path = os.path.join(config.data_dir, "stats_{}.npz".format(data_type))
+    if os.path.exists(stats_path):
+        with np.load(stats_path) as stats:
+            shared['stats'] = dict(stats)
+        filter_key = "all" if data_filter is None else \
+            json.dumps([config.data_filter, config.squash, config.single, config.ques_size_th,
+                        config.num_sents_th, config.sent_size_th, config.para_size_th])
+        shared['stats_key'] = "{}-{}-{}".format(data_type, os.path.getmtime(stats_path), filter_key)
+    else:
+        shared['stats'] = get_length_stats(data, shared)
 
     num_examples = len(next(iter(data.values())))
     if data_filter is None:
         valid_idxs = range(num_examples)
     else:
-        mask = []
-        keys = data.keys()
-        values = data.values()
-        for vals in zip(*values):
-            each = {key: val for key, val in zip(keys, vals)}
-            mask.append(data_filter(each, shared))
-        valid_idxs = [idx for idx in range(len(mask)) if mask[idx]]
+        mask = data_filter(shared['stats'])
+        valid_idxs = np.flatnonzero(mask).tolist()
 
     print("Loaded {}/{} examples from {}".format(len(valid_idxs), num_examples, data_type))
 
@@ -208,95 +430,199 @@ def read_data(config, data_type, ref, data_filter=None):
             shared[key] = val
 
     if config.use_glove_for_unk:
-        # create new word2idx and word2vec
-        word2vec_dict = shared['lower_word2vec'] if config.lower_word else shared['word2vec']
-        new_word2idx_dict = {word: idx for idx, word in enumerate(word for word in word2vec_dict.keys() if word not in shared['word2idx'])}
-        shared['new_word2idx'] = new_word2idx_dict
-        offset = len(shared['word2idx'])
-        word2vec_dict = shared['lower_word2vec'] if config.lower_word else shared['word2vec']
-        new_word2idx_dict = shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        # print("{}/{} unique words have corresponding glove vectors.".format(len(idx2vec_dict), len(word2idx_dict)))
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        shared['new_emb_mat'] = new_emb_mat
+        set_new_emb_mat(config, shared)
 
     data_set = DataSet(data, data_type, shared=shared, valid_idxs=valid_idxs)
     return data_set
 
 
+def set_new_emb_mat(config, shared):
+    """
+    Index the glove words that are not in shared['word2idx'] (shared['new_word2idx']) and stack their vectors (shared['new_emb_mat']).
+    Needs to be called again whenever shared['word2idx'] changes.
+    :param config:
+    :param shared:
+    :return:
+    """
+    # create new word2idx and word2vec
+    word2vec_dict = shared['lower_word2vec'] if config.lower_word else shared['word2vec']
+    new_word2idx_dict = {word: idx for idx, word in enumerate(word for word in word2vec_dict.keys() if word not in shared['word2idx'])}
+    shared['new_word2idx'] = new_word2idx_dict
+    emb_size = len(next(iter(word2vec_dict.values()))) if len(word2vec_dict) > 0 else 0
+    shared['new_emb_mat'] = get_emb_mat(word2vec_dict, new_word2idx_dict, len(new_word2idx_dict), emb_size, dtype='float32')
+
+
+def get_word_id(shared, word, use_glove_for_unk):
+    d = shared['word2idx']
+    for each in (word, word.lower(), word.capitalize(), word.upper()):
+        if each in d:
+            return d[each]
+    if use_glove_for_unk:
+        d2 = shared['new_word2idx']
+        for each in (word, word.lower(), word.capitalize(), word.upper()):
+            if each in d2:
+                return d2[each] + len(d)
+    return 1
+
+
+def index_data(config, data_set):
+    """
+    Convert the tokens of data_set once into int32 arrays so that Model.get_feed_dict only slices and gathers.
+    Must be called after update_config (needs max_word_size).
+    shared['x_ids'] mirrors shared['x'] with a [num_sents, max_sent_len] token id array per paragraph,
+    data['q_ids'] holds a token id array per question (token id 0 is padding),
+    and shared['token2word'] / shared['token2chars'] map token ids to word ids and char ids.
+    Columnar x and q are not copied: their token ids are the columnar vocab ids (plus 1), read from the mapped arrays
+    when a paragraph or question is indexed.
+    :param config:
+    :param data_set:
+    :return:
+    """
+    data, shared = data_set.data, data_set.shared
+    token2idx = {}
+
+    def _get_ids(tokens):
+        return [token2idx.setdefault(token, len(token2idx) + 1) for token in tokens]
+
+    def _get_para_ids(sents):
+        ids = np.zeros([len(sents), max(map(len, sents), default=0)], dtype='int32')
+        for j, sent in enumerate(sents):
+            ids[j, :len(sent)] = _get_ids(sent)
+        return ids
+
+    if isinstance(shared['x'], NestedArray) and isinstance(data['q'], NestedArray):
+        assert shared['x'].vocab is data['q'].vocab
+        _get_ids(shared['x'].vocab)
+        shared['x_ids'] = shared['x'].get_ids()
+        data['q_ids'] = data['q'].get_ids()
+    else:
+        shared['x_ids'] = [[_get_para_ids(para) for para in article] for article in shared['x']]
+        data['q_ids'] = [np.array(_get_ids(ques), dtype='int32') for ques in data['q']]
+    data['*x_ids'] = data['*x']
+
+    token2word = np.zeros([len(token2idx) + 1], dtype='int32')
+    token2chars = np.zeros([len(token2idx) + 1, config.max_word_size], dtype='int32')
+    char2idx = shared['char2idx']
+    for token, idx in token2idx.items():
+        token2word[idx] = get_word_id(shared, token, config.use_glove_for_unk)
+        chars = [char2idx.get(char, 1) for char in token[:config.max_word_size]]
+        token2chars[idx, :len(chars)] = chars
+    shared['token2word'] = token2word
+    shared['token2chars'] = token2chars
+
+
 def get_squad_data_filter(config):
-    def data_filter(data_point, shared):
-        assert shared is not None
-        rx, rcx, q, cq, y = (data_point[key] for key in ('*x', '*cx', 'q', 'cq', 'y'))
-        x, cx = shared['x'], shared['cx']
-        if len(q) > config.ques_size_th:
-            return False
+    def data_filter(stats):
+        """
+        :param stats: from get_length_stats
+        :return: boolean mask over the examples
+        """
+        answer_idxs = stats['answer_idxs']
+        mask = stats['ques_size'] <= config.ques_size_th
+
+        def _all_answers(answer_mask):
+            # examples whose answers all satisfy answer_mask (examples without answers included)
+            return np.bincount(answer_idxs[~answer_mask], minlength=len(mask)) == 0
 
         # x filter
-        xi = x[rx[0]][rx[1]]
         if config.squash:
-            for start, stop in y:
-                stop_offset = sum(map(len, xi[:stop[0]]))
-                if stop_offset + stop[1] > config.para_size_th:
-                    return False
-            return True
+            return mask & _all_answers(stats['para_stop_word'] <= config.para_size_th)
 
+        same_sent = stats['start_sent'] == stats['stop_sent']
         if config.single:
-            for start, stop in y:
-                if start[0] != stop[0]:
-                    return False
+            mask &= _all_answers(same_sent)
 
         if config.data_filter == 'max':
-            for start, stop in y:
-                    if stop[0] >= config.num_sents_th:
-                        return False
-                    if start[0] != stop[0]:
-                        return False
-                    if stop[1] >= config.sent_size_th:
-                        return False
+            mask &= _all_answers((stats['stop_sent'] < config.num_sents_th) & same_sent &
+                                 (stats['stop_word'] < config.sent_size_th))
         elif config.data_filter == 'valid':
-            if len(xi) > config.num_sents_th:
-                return False
-            if any(len(xij) > config.sent_size_th for xij in xi):
-                return False
+            mask &= (stats['num_sents'] <= config.num_sents_th) & (stats['max_sent_size'] <= config.sent_size_th)
         elif config.data_filter == 'semi':
             """
             Only answer sentence needs to be valid.
+            (The start sentence has never been compared to the stop sentence here.)
             """
-            for start, stop in y:
-                if stop[0] >= config.num_sents_th:
-                    return False
-                if start[0] != start[0]:
-                    return False
-                if len(xi[start[0]]) > config.sent_size_th:
-                    return False
+            mask &= _all_answers((stats['stop_sent'] < config.num_sents_th) &
+                                 (stats['start_sent_size'] <= config.sent_size_th))
         else:
             raise Exception()
 
-        return True
+        return mask
     return data_filter
 
 
+def get_bucketed_epoch_stats(config, data_set):
+    """
+    Steps and padding efficiency of one bucketed (cluster) training epoch, with batches as get_multi_batches draws them.
+    The bucketing is not shuffled, so nothing is drawn from the random state; only the order of ties differs from training.
+    :param config:
+    :param data_set:
+    :return: (num_steps, padding efficiency)
+    """
+    if config.token_budget > 0:
+        towers = data_set.get_bucketed_groups(config.batch_size, token_budget=config.token_budget, squash=config.squash,
+                                              num_groups_per_step=config.num_gpus, shuffle=False)
+        num_steps = len(towers) // config.num_gpus
+    else:
+        groups = data_set.get_bucketed_groups(config.batch_size * config.num_gpus, squash=config.squash, shuffle=False)
+        num_steps = len(groups)
+        # steps are split into towers as DataSet.divide does
+        towers = [tower for group in groups for tower in
+                  grouper(group, int(math.ceil(len(group) / config.num_gpus)), shorten=True, num_groups=config.num_gpus)]
+    efficiency = data_set.get_padding_efficiency(towers, squash=config.squash,
+                                                 batch_size=None if config.token_budget > 0 else config.batch_size,
+                                                 max_num_sents=None if config.cpu_opt else config.max_num_sents,
+                                                 max_sent_size=None if config.len_opt else config.max_sent_size)
+    return num_steps, efficiency
+
+
+def get_max_sizes(config, data_set):
+    """
+    Max lengths over the valid examples of data_set, reduced from the length statistics.
+    Cached in data_dir when the statistics come from squad.prepro (keyed by data type, file time and filter thresholds).
+    :param config:
+    :param data_set:
+    :return: dict of max_para_size, max_num_sents, max_sent_size, max_word_size, max_ques_size
+    """
+    shared = data_set.shared
+    cache_key = shared.get('stats_key')
+    cache_path = os.path.join(config.data_dir, "stats_cache.json")
+    cache = {}
+    if cache_key is not None and os.path.exists(cache_path):
+        with open(cache_path, 'r') as fh:
+            try:
+                cache = json.load(fh)
+            except ValueError:
+                # e.g. left over by an older, interrupted write; rebuilt below
+                cache = {}
+        if cache_key in cache:
+            return cache[cache_key]
+
+    stats = shared['stats'] if 'stats' in shared else get_length_stats(data_set.data, shared)
+    idxs = np.array(list(data_set.valid_idxs), dtype='int64')
+
+    def _max(key):
+        return int(stats[key][idxs].max()) if len(idxs) > 0 else 0
+
+    max_sizes = {'max_para_size': _max('para_size'), 'max_num_sents': _max('num_sents'),
+                 'max_sent_size': _max('max_sent_size'), 'max_word_size': _max('max_word_size'),
+                 'max_ques_size': _max('ques_size')}
+    if cache_key is not None:
+        cache[cache_key] = max_sizes
+        # written aside and renamed, so that concurrent or interrupted runs never leave a partial file
+        tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump(cache, fh)
+        os.replace(tmp_path, cache_path)
+    return max_sizes
+
+
 def update_config(config, data_sets):
-    config.max_num_sents = 0
-    config.max_sent_size = 0
-    config.max_ques_size = 0
-    config.max_word_size = 0
-    config.max_para_size = 0
+    for key in ('max_num_sents', 'max_sent_size', 'max_ques_size', 'max_word_size', 'max_para_size'):
+        config.__setattr__(key, 0)
     for data_set in data_sets:
-        data = data_set.data
-        shared = data_set.shared
-        for idx in data_set.valid_idxs:
-            rx = data['*x'][idx]
-            q = data['q'][idx]
-            sents = shared['x'][rx[0]][rx[1]]
-            config.max_para_size = max(config.max_para_size, sum(map(len, sents)))
-            config.max_num_sents = max(config.max_num_sents, len(sents))
-            config.max_sent_size = max(config.max_sent_size, max(map(len, sents)))
-            config.max_word_size = max(config.max_word_size, max(len(word) for sent in sents for word in sent))
-            if len(q) > 0:
-                config.max_ques_size = max(config.max_ques_size, len(q))
-                config.max_word_size = max(config.max_word_size, max(len(word) for word in q))
+        for key, val in get_max_sizes(config, data_set).items():
+            config.__setattr__(key, max(getattr(config, key), val))
 
     if config.mode == 'train':
         config.max_num_sents = min(config.max_num_sents, config.num_sents_th)
@@ -314,3 +640,23 @@ def update_config(config, data_sets):
     if config.squash:
         config.max_sent_size = config.max_para_size
         config.max_num_sents = 1
+
+
+def update_config_from_shared(config, shared):
+    """
+    update_config for when the data is not known in advance (serving, export): sizes are the thresholds,
+    vocab sizes come from shared.json (word2idx and char2idx), and word vectors are assumed to be GloVe's.
+    """
+    config.max_num_sents = config.num_sents_th
+    config.max_sent_size = config.sent_size_th
+    config.max_ques_size = config.ques_size_th
+    config.max_word_size = config.word_size_th
+    config.max_para_size = config.para_size_th
+    config.char_vocab_size = len(shared['char2idx'])
+    config.word_vocab_size = len(shared['word2idx'])
+    config.word_emb_size = config.glove_vec_size
+    if config.single:
+        config.max_num_sents = 1
+    if config.squash:
+        config.max_sent_size = config.max_para_size
+        config.max_num_sents = 1
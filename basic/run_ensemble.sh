@@ -15,15 +15,12 @@ fi
 # Preprocess data
 python3 -m squad.prepro --mode single --single_path $source_path $parg --target_dir $inter_dir --glove_dir .
 
-eargs=""
+load_paths=""
+shared_paths=""
 for num in 31 33 34 35 36 37 40 41 43 44 45 46; do
-    load_path="$root_dir/$num/save"
-    shared_path="$root_dir/$num/shared.json"
-    eval_path="$inter_dir/eval-$num.json"
-    eargs="$eargs $eval_path"
-    python3 -m basic.cli --data_dir $inter_dir --eval_path $eval_path --nodump_answer --load_path $load_path --shared_path $shared_path $marg --eval_num_batches 0 --mode forward --batch_size 1 --len_opt --cluster --cpu_opt --load_ema &
+    load_paths="$load_paths,$root_dir/$num/save"
+    shared_paths="$shared_paths,$root_dir/$num/shared.json"
 done
-wait
 
-# Ensemble
-python3 -m basic.ensemble --data_path $inter_dir/data_single.json --shared_path $inter_dir/shared_single.json -o $target_path $eargs
+# Run all models in one process and ensemble their outputs
+python3 -m basic.cli --data_dir $inter_dir --answer_path $target_path --load_path ${load_paths:1} --shared_path ${shared_paths:1} $marg --mode ensemble --batch_size 1 --len_opt --cpu_opt --load_ema
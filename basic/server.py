@@ -0,0 +1,475 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from pprint import pprint
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn
+
+import numpy as np
+import tensorflow as tf
+
+from basic.evaluator import ForwardEvaluator, EvaluationAccumulator
+from basic.graph_handler import GraphHandler
+from basic.model import get_multi_gpu_models
+from basic.read_data import DataSet, get_word_id, update_config_from_shared
+from my.glove_utils import load_glove
+from squad.prepro import prepro_article, get_tokenizers
+
+
+class RequestError(ValueError):
+    """
+    An invalid request (answered with 400 over HTTP), as opposed to an error while answering it.
+    """
+    pass
+
+
+class ContextCache(object):
+    """
+    LRU cache of processed contexts keyed by a hash of the context text, evicted by total size in bytes.
+    An entry holds the tokenized paragraph ('x'), its text as used for answers ('p'), its token ids ('x_ids')
+    with their own tables ('token2word', 'token2chars', 'emb_mat'; see Server._index_tokens)
+    and, with cache_h, its encoding ('h').
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    @staticmethod
+    def get_key(context):
+        return hashlib.sha1(context.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_entry_size(entry):
+        size = len(entry['p']) + sum(len(token) for sent in entry['x'] for token in sent)
+        keys = ('x_ids', 'token2word', 'token2chars', 'emb_mat', 'h')
+        return size + sum(entry[key].nbytes for key in keys if key in entry)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)['size']
+        entry['size'] = self._get_entry_size(entry)
+        if entry['size'] > self.max_size:
+            return
+        self.entries[key] = entry
+        self.size += entry['size']
+        while self.size > self.max_size:
+            _, old_entry = self.entries.popitem(last=False)
+            self.size -= old_entry['size']
+            self.evictions += 1
+
+    def get_stats(self):
+        return {'entries': len(self.entries), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class Server(object):
+    """
+    Keeps the restored model and the GloVe vectors in memory and answers (context, question) pairs,
+    tokenizing them in-process the same way squad.prepro does.
+    Each cached context keeps its own token tables, so that nothing outlives the cache entries.
+    """
+    def __init__(self, config):
+        self.config = config
+        shared_path = config.shared_path or os.path.join(config.out_dir, "shared.json")
+        with open(shared_path, 'r') as fh:
+            shared = json.load(fh)
+        self.word2idx = shared['word2idx']
+        self.char2idx = shared['char2idx']
+        self.prepro_args = argparse.Namespace(tokenizer=config.tokenizer, split=config.split, url=config.corenlp_url,
+                                              port=config.corenlp_port, debug=False, skip_chars=True)
+        _, self.word_tokenize = get_tokenizers(self.prepro_args)
+
+        self.glove_word2idx = {}
+        self.glove_mat = None
+        if config.use_glove_for_unk:
+            words, self.glove_mat = load_glove(config)
+            for idx, word in enumerate(words):
+                self.glove_word2idx.setdefault(word, idx)
+
+        # requests are not known in advance: the thresholds are the limits of a request (see _check_sizes),
+        # and each batch is sized from its own data as in forward mode with len_opt
+        update_config_from_shared(config, shared)
+        config.len_opt, config.cpu_opt = True, True
+
+        self.context_cache = ContextCache(config.context_cache_mb * 2 ** 20)
+
+        pprint(config.__flags, indent=2)
+        models = get_multi_gpu_models(config)
+        self.model = models[0]
+        self.evaluator = ForwardEvaluator(config, self.model)
+        self.graph_handler = GraphHandler(config, self.model)
+        self.sess = tf.Session(config=tf.ConfigProto(allow_soft_placement=True))
+        self.graph_handler.initialize(self.sess)
+
+    def _get_glove_idx(self, word):
+        for each in (word, word.lower(), word.capitalize(), word.upper()):
+            if each in self.glove_word2idx:
+                return self.glove_word2idx[each]
+        return None
+
+    def _index_tokens(self, sents):
+        """
+        Token ids of sents with tables of their own, in the layout of read_data.index_data:
+        'ids' is [len(sents), max_sent_len] (0 is padding), 'token2word' and 'token2chars' map ids to word and char ids,
+        and 'emb_mat' holds the GloVe rows of the words out of word2idx (word id len(word2idx) + row).
+        Tables of several calls are combined per request by _merge_tables.
+        """
+        config = self.config
+        token2idx = {}
+        ids = np.zeros([len(sents), max(map(len, sents), default=0)], dtype='int32')
+        for j, sent in enumerate(sents):
+            for k, token in enumerate(sent):
+                ids[j, k] = token2idx.setdefault(token, len(token2idx) + 1)
+
+        new_word2idx = {}
+        glove_idxs = []
+        for token in token2idx:
+            word = token.lower() if config.lower_word else token
+            if not config.use_glove_for_unk or word in self.word2idx or word in new_word2idx:
+                continue
+            glove_idx = self._get_glove_idx(word)
+            if glove_idx is not None:
+                new_word2idx[word] = len(glove_idxs)
+                glove_idxs.append(glove_idx)
+        emb_mat = np.zeros([len(glove_idxs), config.word_emb_size], dtype='float32')
+        if len(glove_idxs) > 0:
+            emb_mat[:] = self.glove_mat[glove_idxs]
+
+        shared = {'word2idx': self.word2idx, 'new_word2idx': new_word2idx}
+        token2word = np.zeros([len(token2idx) + 1], dtype='int32')
+        token2chars = np.zeros([len(token2idx) + 1, config.max_word_size], dtype='int32')
+        for token, idx in token2idx.items():
+            token2word[idx] = get_word_id(shared, token, config.use_glove_for_unk)
+            chars = [self.char2idx.get(char, 1) for char in token[:config.max_word_size]]
+            token2chars[idx, :len(chars)] = chars
+        return {'ids': ids, 'token2word': token2word, 'token2chars': token2chars, 'emb_mat': emb_mat}
+
+    def _merge_tables(self, tables):
+        """
+        Concatenate the tables of _index_tokens, so that a request feeds only the GloVe rows of its own words.
+        :param tables: list of dicts with 'token2word', 'token2chars' and 'emb_mat'
+        :return: (token2word, token2chars, new_emb_mat, token offsets), ids of tables[i] are shifted by offsets[i]
+        """
+        offsets, emb_offsets = [], []
+        num_tokens, num_rows = 0, 0
+        for table in tables:
+            offsets.append(num_tokens)
+            emb_offsets.append(num_rows)
+            num_tokens += len(table['token2word'])
+            num_rows += len(table['emb_mat'])
+        num_words = len(self.word2idx)
+        token2word = np.concatenate([np.where(table['token2word'] >= num_words, table['token2word'] + emb_offset,
+                                              table['token2word'])
+                                     for table, emb_offset in zip(tables, emb_offsets)])
+        token2chars = np.concatenate([table['token2chars'] for table in tables])
+        new_emb_mat = np.concatenate([table['emb_mat'] for table in tables])
+        return token2word, token2chars, new_emb_mat, offsets
+
+    def _get_context_entries(self, contexts):
+        """
+        :param contexts: distinct contexts
+        :return: list of (key, entry), from the cache or freshly processed
+        """
+        keys = [ContextCache.get_key(context) for context in contexts]
+        entries = [self.context_cache.get(key) for key in keys]
+        missing = [i for i, entry in enumerate(entries) if entry is None]
+        if len(missing) > 0:
+            article = {'paragraphs': [{'context': contexts[i], 'qas': []} for i in missing]}
+            out, _ = prepro_article(self.prepro_args, 0, article)
+            for i, xi, pi in zip(missing, out['x'], out['p']):
+                table = self._index_tokens(xi)
+                entries[i] = {'x': xi, 'p': pi, 'x_ids': table.pop('ids')}
+                entries[i].update(table)
+                self.context_cache.put(keys[i], entries[i])
+        return list(zip(keys, entries))
+
+    def _check_sizes(self, context_entries, q):
+        """
+        Reject empty contexts and questions, and ones over the thresholds, which Model.get_feed_dict would otherwise truncate.
+        """
+        config = self.config
+        for _, entry in context_entries:
+            sent_lens = list(map(len, entry['x']))
+            if sum(sent_lens) == 0:
+                raise RequestError("context has no tokens")
+            if config.squash:
+                num_sents, sent_size = 1, sum(sent_lens)
+            else:
+                num_sents, sent_size = len(sent_lens), max(sent_lens, default=0)
+            if not config.single and num_sents > config.max_num_sents:
+                raise RequestError("context has {} sentences, more than {}".format(num_sents, config.max_num_sents))
+            if sent_size > config.max_sent_size:
+                raise RequestError("context has {} tokens in a sentence, more than {}".format(sent_size, config.max_sent_size))
+        for qi in q:
+            if len(qi) == 0:
+                raise RequestError("question has no tokens")
+            if len(qi) > config.max_ques_size:
+                raise RequestError("question has {} tokens, more than {}".format(len(qi), config.max_ques_size))
+
+    def get_data_set(self, pairs):
+        """
+        Tokenize (context, question) pairs into a DataSet in the layout of squad.prepro + read_data + index_data.
+        Each distinct context becomes one paragraph. Answers are unknown, so each example gets a dummy span.
+        :param pairs: list of (context, question)
+        :return:
+        """
+        contexts = list(OrderedDict.fromkeys(context for context, _ in pairs))
+        context_entries = self._get_context_entries(contexts)
+        pis = {context: pi for pi, context in enumerate(contexts)}
+        q = [self.word_tokenize(question) for _, question in pairs]
+        self._check_sizes(context_entries, q)
+        q_table = self._index_tokens(q)
+        token2word, token2chars, new_emb_mat, offsets = \
+            self._merge_tables([entry for _, entry in context_entries] + [q_table])
+        x_ids = [np.where(entry['x_ids'] > 0, entry['x_ids'] + offset, 0)
+                 for (_, entry), offset in zip(context_entries, offsets)]
+        q_ids = [q_table['ids'][i, :len(qi)] + offsets[-1] for i, qi in enumerate(q)]
+        rx = [[0, pis[context]] for context, _ in pairs]
+        num_examples = len(pairs)
+        data = {'q': q, 'q_ids': q_ids,
+                'y': [[[[0, 0], [0, 1]]] for _ in range(num_examples)], '*x': rx, '*p': rx, '*x_ids': rx,
+                'idxs': list(range(num_examples)), 'ids': [str(i) for i in range(num_examples)],
+                'answerss': [[] for _ in range(num_examples)]}
+        shared = {'x': [[entry['x'] for _, entry in context_entries]], 'p': [[entry['p'] for _, entry in context_entries]],
+                  'x_ids': [x_ids], 'context_entries': context_entries,
+                  'word2idx': self.word2idx, 'char2idx': self.char2idx,
+                  'new_emb_mat': new_emb_mat, 'token2word': token2word, 'token2chars': token2chars}
+        return DataSet(data, 'serve', shared=shared)
+
+    def _feed_h(self, data_set, feed_dict):
+        """
+        Feed the encodings of the batch's contexts from the cache, computing (and caching) them if any is missing.
+        """
+        model = self.model
+        x_mask = feed_dict[model.x_mask]
+        if self.config.dedup_x:
+            # the first question of each row of x
+            _, x_examples = np.unique(feed_dict[model.x_idx][:data_set.num_examples], return_index=True)
+        else:
+            x_examples = range(data_set.num_examples)
+        context_entries = data_set.shared['context_entries']
+        rows = [(i, context_entries[data_set.data['*x'][ei][1]]) for i, ei in enumerate(x_examples)]
+        if all('h' in entry for _, (_, entry) in rows):
+            h = np.zeros(list(x_mask.shape) + [2 * self.config.hidden_size], dtype='float32')
+            for i, (_, entry) in rows:
+                m, jx, _ = entry['h'].shape
+                h[i, :m, :jx] = entry['h']
+        else:
+            h = self.sess.run(model.h, feed_dict=feed_dict)
+            for i, (key, entry) in rows:
+                # outputs past the end of a sentence are 0, so only the part under x_mask is kept
+                m, jx = max(1, x_mask[i].any(1).sum()), max(1, x_mask[i].any(0).sum())
+                entry['h'] = h[i, :m, :jx].copy()
+                self.context_cache.put(key, entry)
+        feed_dict[model.h] = h
+
+    def answer(self, pairs):
+        """
+        :param pairs: list of (context, question)
+        :return: list of {'answer': str, 'score': float}, in the order of pairs
+        """
+        if len(pairs) == 0:
+            return []
+        data_set = self.get_data_set(pairs)
+        num_batches = int(math.ceil(data_set.num_examples / self.config.batch_size))
+        accumulator = EvaluationAccumulator()
+        for batch in data_set.get_batches(self.config.batch_size, num_batches=num_batches):
+            feed_dict = self.model.get_feed_dict(batch[1], False)
+            if self.config.cache_h:
+                self._feed_h(batch[1], feed_dict)
+            accumulator.add(self.evaluator.get_evaluation(self.sess, batch, feed_dict=feed_dict))
+        e = accumulator.get()
+        scores = e.id2answer_dict['scores']
+        return [{'answer': e.id2answer_dict[id_], 'score': float(scores[id_])} for id_ in data_set.data['ids']]
+
+
+class BatchScheduler(object):
+    """
+    Gathers concurrent requests for up to batch_window milliseconds or batch_size questions
+    and answers them with a single Server.answer call, so that the batch dimension is not wasted on one question.
+    """
+    def __init__(self, server, batch_size, batch_window):
+        self.server = server
+        self.batch_size = batch_size
+        self.batch_window = batch_window / 1000.0
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, pairs):
+        """
+        :param pairs: list of (context, question)
+        :return: Future of the list of answers, in the order of pairs
+        """
+        future = Future()
+        self.queue.put((pairs, future))
+        return future
+
+    def answer(self, pairs):
+        return self.submit(pairs).result()
+
+    def _get_requests(self):
+        requests = [self.queue.get()]
+        num_pairs = len(requests[0][0])
+        deadline = time.time() + self.batch_window
+        while num_pairs < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except Empty:
+                break
+            requests.append(request)
+            num_pairs += len(request[0])
+        return requests
+
+    def _answer(self, requests):
+        pairs = [pair for each, _ in requests for pair in each]
+        try:
+            answers = self.server.answer(pairs)
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0][1].set_exception(e)
+                return
+            # answer the requests one at a time, so that only the failing one gets the error
+            for request in requests:
+                self._answer([request])
+            return
+        start = 0
+        for each, future in requests:
+            future.set_result(answers[start:start + len(each)])
+            start += len(each)
+
+    def _run(self):
+        while True:
+            self._answer(self._get_requests())
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _parse_request(obj):
+    """
+    A request is {"context": ..., "question": ...} or a list of them, with non-empty string values.
+    Raises RequestError for any other request.
+    :return: (pairs, is_list)
+    """
+    is_list = isinstance(obj, list)
+    pairs = []
+    for each in (obj if is_list else [obj]):
+        if not isinstance(each, dict):
+            raise RequestError("expected an object with 'context' and 'question', got {}".format(type(each).__name__))
+        for key in ('context', 'question'):
+            if not isinstance(each.get(key), str):
+                raise RequestError("'{}' must be a string".format(key))
+            if len(each[key].strip()) == 0:
+                raise RequestError("'{}' must not be empty".format(key))
+        pairs.append((each['context'], each['question']))
+    return pairs, is_list
+
+
+def _get_handler_class(scheduler):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') != '/stats':
+                self._respond(404, {'error': "not found"})
+                return
+            self._respond(200, {'context_cache': scheduler.server.context_cache.get_stats()})
+
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                pairs, is_list = _parse_request(json.loads(self.rfile.read(length).decode('utf-8')))
+            except ValueError as e:
+                # a bad Content-Length, malformed json (both ValueErrors) or a RequestError
+                self._respond(400, {'error': str(e)})
+                return
+            try:
+                answers = scheduler.answer(pairs)
+            except RequestError as e:
+                self._respond(400, {'error': str(e)})
+                return
+            except Exception as e:
+                self._respond(500, {'error': str(e)})
+                return
+            self._respond(200, answers if is_list else answers[0])
+
+        def _respond(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def _print_answers(futures):
+    while True:
+        item = futures.get()
+        if item is None:
+            return
+        future, is_list = item
+        try:
+            answers = future.result()
+            print(json.dumps(answers if is_list else answers[0]), flush=True)
+        except Exception as e:
+            print(json.dumps({'error': str(e)}), flush=True)
+
+
+def serve(config):
+    """
+    Answer requests over HTTP (POST json to serve_host:serve_port), or as json lines on stdin/stdout if serve_port is 0.
+    Concurrent requests (or consecutive lines) are batched together by BatchScheduler.
+    """
+    server = Server(config)
+    scheduler = BatchScheduler(server, config.batch_size, config.batch_window)
+    if config.serve_port == 0:
+        # answers are printed in the order of the lines, while later lines are already being batched
+        futures = Queue()
+        printer = threading.Thread(target=_print_answers, args=(futures,))
+        printer.start()
+        for line in sys.stdin:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                pairs, is_list = _parse_request(json.loads(line))
+            except ValueError as e:
+                # printed as an error line in turn with the answers
+                future = Future()
+                future.set_exception(e)
+                futures.put((future, False))
+                continue
+            futures.put((scheduler.submit(pairs), is_list))
+        futures.put(None)
+        printer.join()
+        return
+
+    httpd = ThreadingHTTPServer((config.serve_host, config.serve_port), _get_handler_class(scheduler))
+    print("Serving on {}:{}".format(config.serve_host, config.serve_port))
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
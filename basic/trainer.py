@@ -46,9 +46,21 @@ class MultiGPUTrainer(object):
         self.models = models
         losses = []
         grads_list = []
-        for gpu_idx, model in enumerate(models):
+        if config.token_budget:
+            # towers get different numbers of examples, so each is weighted by its share of the step's examples
+            # (times the number of towers, since losses and gradients are averaged over towers below)
+            tower_sizes = [tf.cast(tf.shape(model.q)[0], 'float') for model in models]
+            tower_weights = [len(models) * size / tf.maximum(tf.add_n(tower_sizes), 1.0) for size in tower_sizes]
+        else:
+            tower_sizes = [None for _ in models]
+            tower_weights = [1.0 for _ in models]
+        for gpu_idx, (model, size, weight) in enumerate(zip(models, tower_sizes, tower_weights)):
             with tf.name_scope("grads_{}".format(gpu_idx)), tf.device("/{}:{}".format(config.device_type, gpu_idx)):
                 loss = model.get_loss()
+                if size is not None:
+                    # the mean loss of an empty tower is NaN, and would stay NaN with a zero weight
+                    loss = tf.select(tf.greater(size, 0.0), loss, tf.zeros_like(loss))
+                loss = loss * weight
                 grads = self.opt.compute_gradients(loss, var_list=self.var_list)
                 losses.append(loss)
                 grads_list.append(grads)
@@ -57,12 +69,17 @@ class MultiGPUTrainer(object):
         self.grads = average_gradients(grads_list)
         self.train_op = self.opt.apply_gradients(self.grads, global_step=self.global_step)
 
-    def step(self, sess, batches, get_summary=False):
-        assert isinstance(sess, tf.Session)
+    def get_feed_dict(self, batches):
         feed_dict = {}
         for batch, model in zip(batches, self.models):
             _, ds = batch
             feed_dict.update(model.get_feed_dict(ds, True))
+        return feed_dict
+
+    def step(self, sess, batches, get_summary=False, feed_dict=None):
+        assert isinstance(sess, tf.Session)
+        if feed_dict is None:
+            feed_dict = self.get_feed_dict(batches)
 
         if get_summary:
             loss, summary, train_op = \
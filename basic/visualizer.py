@@ -11,6 +11,7 @@ from tqdm import tqdm
 from jinja2 import Environment, FileSystemLoader
 
 from basic.evaluator import get_span_score_pairs
+from my.columnar import load_ragged_dict
 from squad.utils import get_best_span, get_span_score_pairs
 
 
@@ -39,6 +40,14 @@ def get_args():
     return args
 
 
+def _pad(ypi, para):
+    # binary dumps only keep the real sentences and tokens of each example
+    out = np.zeros([len(para), max(map(len, para))])
+    m, n = min(out.shape[0], ypi.shape[0]), min(out.shape[1], ypi.shape[1])
+    out[:m, :n] = ypi[:m, :n]
+    return out.tolist()
+
+
 def _decode(decoder, sent):
     return " ".join(decoder[idx] for idx in sent)
 
@@ -52,8 +61,14 @@ def accuracy2_visualizer(args):
     step = args.step
 
     eval_path =os.path.join("out", model_name, run_id, "eval", "{}-{}.json".format(data_type, str(step).zfill(6)))
-    print("loading {}".format(eval_path))
-    eval_ = json.load(open(eval_path, 'r'))
+    binary_eval_path = os.path.join("out", model_name, run_id, "eval", "{}-{}.bin".format(data_type, str(step).zfill(6)))
+    binary = not os.path.exists(eval_path) and os.path.exists(binary_eval_path)
+    if binary:
+        print("loading {}".format(binary_eval_path))
+        eval_ = load_ragged_dict(binary_eval_path)
+    else:
+        print("loading {}".format(eval_path))
+        eval_ = json.load(open(eval_path, 'r'))
 
     _id = 0
     html_dir = "/tmp/list_results%d" % _id
@@ -84,6 +99,8 @@ def accuracy2_visualizer(args):
         x = shared['x'][rx[0]][rx[1]]
         ques = [" ".join(q)]
         para = [[word for word in sent] for sent in x]
+        if binary:
+            ypi, yp2i = _pad(ypi, para), _pad(yp2i, para)
         span = get_best_span(ypi, yp2i)
         ap = get_segment(para, span)
         score = "{:.3f}".format(ypi[span[0][0]][span[0][1]] * yp2i[span[1][0]][span[1][1]-1])
@@ -7,7 +7,6 @@ from pprint import pprint
 
 import tensorflow as tf
 from tqdm import tqdm
-import numpy as np
 
 from basic_cnn.evaluator import F1Evaluator, Evaluator, ForwardEvaluator, MultiGPUF1Evaluator, CNNAccuracyEvaluator, \
     MultiGPUCNNAccuracyEvaluator
@@ -16,6 +15,7 @@ from basic_cnn.model import Model, get_multi_gpu_models
 from basic_cnn.trainer import Trainer, MultiGPUTrainer
 
 from basic_cnn.read_data import read_data, get_cnn_data_filter, update_config
+from my.utils import get_emb_mat
 
 
 def main(config):
@@ -53,11 +53,8 @@ def _train(config):
 
     word2vec_dict = train_data.shared['lower_word2vec'] if config.lower_word else train_data.shared['word2vec']
     word2idx_dict = train_data.shared['word2idx']
-    idx2vec_dict = {word2idx_dict[word]: vec for word, vec in word2vec_dict.items() if word in word2idx_dict}
-    print("{}/{} unique words have corresponding glove vectors.".format(len(idx2vec_dict), len(word2idx_dict)))
-    emb_mat = np.array([idx2vec_dict[idx] if idx in idx2vec_dict
-                        else np.random.multivariate_normal(np.zeros(config.word_emb_size), np.eye(config.word_emb_size))
-                        for idx in range(config.word_vocab_size)])
+    print("{}/{} unique words have corresponding glove vectors.".format(sum(word in word2vec_dict for word in word2idx_dict), len(word2idx_dict)))
+    emb_mat = get_emb_mat(word2vec_dict, word2idx_dict, config.word_vocab_size, config.word_emb_size)
     config.emb_mat = emb_mat
 
     # construct model graph and variables (using default graph)
@@ -120,12 +117,7 @@ def _test(config):
     _config_draft(config)
 
     if config.use_glove_for_unk:
-        word2vec_dict = test_data.shared['lower_word2vec'] if config.lower_word else test_data.shared['word2vec']
-        new_word2idx_dict = test_data.shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        # print("{}/{} unique words have corresponding glove vectors.".format(len(idx2vec_dict), len(word2idx_dict)))
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        config.new_emb_mat = new_emb_mat
+        config.new_emb_mat = test_data.shared['new_emb_mat']
 
     pprint(config.__flags, indent=2)
     models = get_multi_gpu_models(config)
@@ -166,12 +158,7 @@ def _forward(config):
     _config_draft(config)
 
     if config.use_glove_for_unk:
-        word2vec_dict = test_data.shared['lower_word2vec'] if config.lower_word else test_data.shared['word2vec']
-        new_word2idx_dict = test_data.shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        # print("{}/{} unique words have corresponding glove vectors.".format(len(idx2vec_dict), len(word2idx_dict)))
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        config.new_emb_mat = new_emb_mat
+        config.new_emb_mat = test_data.shared['new_emb_mat']
 
     pprint(config.__flags, indent=2)
     models = get_multi_gpu_models(config)
@@ -5,11 +5,9 @@ import itertools
 import math
 from collections import defaultdict
 
-import numpy as np
-
 from cnn_dm.prepro import para2sents
 from my.tensorflow import grouper
-from my.utils import index
+from my.utils import index, get_emb_mat
 
 
 class Data(object):
@@ -257,13 +255,8 @@ def read_data(config, data_type, ref, data_filter=None):
         word2vec_dict = shared['lower_word2vec'] if config.lower_word else shared['word2vec']
         new_word2idx_dict = {word: idx for idx, word in enumerate(word for word in word2vec_dict.keys() if word not in shared['word2idx'])}
         shared['new_word2idx'] = new_word2idx_dict
-        offset = len(shared['word2idx'])
-        word2vec_dict = shared['lower_word2vec'] if config.lower_word else shared['word2vec']
-        new_word2idx_dict = shared['new_word2idx']
-        idx2vec_dict = {idx: word2vec_dict[word] for word, idx in new_word2idx_dict.items()}
-        # print("{}/{} unique words have corresponding glove vectors.".format(len(idx2vec_dict), len(word2idx_dict)))
-        new_emb_mat = np.array([idx2vec_dict[idx] for idx in range(len(idx2vec_dict))], dtype='float32')
-        shared['new_emb_mat'] = new_emb_mat
+        emb_size = len(next(iter(word2vec_dict.values()))) if len(word2vec_dict) > 0 else 0
+        shared['new_emb_mat'] = get_emb_mat(word2vec_dict, new_word2idx_dict, len(new_word2idx_dict), emb_size, dtype='float32')
 
     data = MyData(config, os.path.join(config.root_dir, data_type), paths)
     data_set = MyDataSet(data, data_type, shared=shared, valid_idxs=valid_idxs)
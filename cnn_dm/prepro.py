@@ -9,6 +9,7 @@ from collections import Counter
 from tqdm import tqdm
 
 from my.utils import process_tokens
+from my.glove_utils import get_word2vecs
 from squad.utils import get_word_span, process_tokens
 
 
@@ -68,29 +69,6 @@ def para2sents(para, width):
     return sents
 
 
-def get_word2vec(args, word_counter):
-    glove_path = os.path.join(args.glove_dir, "glove.{}.{}d.txt".format(args.glove_corpus, args.glove_vec_size))
-    sizes = {'6B': int(4e5), '42B': int(1.9e6), '840B': int(2.2e6), '2B': int(1.2e6)}
-    total = sizes[args.glove_corpus]
-    word2vec_dict = {}
-    with open(glove_path, 'r', encoding='utf-8') as fh:
-        for line in tqdm(fh, total=total):
-            array = line.lstrip().rstrip().split(" ")
-            word = array[0]
-            vector = list(map(float, array[1:]))
-            if word in word_counter:
-                word2vec_dict[word] = vector
-            elif word.capitalize() in word_counter:
-                word2vec_dict[word.capitalize()] = vector
-            elif word.lower() in word_counter:
-                word2vec_dict[word.lower()] = vector
-            elif word.upper() in word_counter:
-                word2vec_dict[word.upper()] = vector
-
-    print("{}/{} of word vocab have corresponding vectors in {}".format(len(word2vec_dict), len(word_counter), glove_path))
-    return word2vec_dict
-
-
 def prepro_each(args, mode):
     source_dir = os.path.join(args.source_dir, mode)
     word_counter = Counter()
@@ -161,8 +139,7 @@ def prepro_each(args, mode):
     sorted_file_names, lens = zip(*sorted(zip(out_file_names, lens), key=lambda each: each[1]))
     assert lens[-1] == max_num_sents
 
-    word2vec_dict = get_word2vec(args, word_counter)
-    lower_word2vec_dit = get_word2vec(args, lower_word_counter)
+    word2vec_dict, lower_word2vec_dit = get_word2vecs(args, [word_counter, lower_word_counter])
 
     shared = {'word_counter': word_counter, 'ent_counter': ent_counter, 'char_counter': char_counter,
               'lower_word_counter': lower_word_counter,
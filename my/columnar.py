@@ -0,0 +1,213 @@
+import json
+import os
+
+import numpy as np
+
+
+class NestedArray(object):
+    """
+    Read-only nested list of tokens backed by a flat array of vocab ids and one offset array per nesting level.
+    Indexing returns a lighter NestedArray while more than two levels remain, and plain (decoded) python lists
+    for the innermost two levels, so it can be used wherever the nested json lists were used.
+    """
+    def __init__(self, values, offsets, vocab, start=0, stop=None):
+        self.values = values
+        self.offsets = offsets  # outermost first, offsets[-1] indexes into values
+        self.vocab = vocab  # vocab id -> token
+        self.start = start
+        self.stop = len(offsets[0]) - 1 if stop is None else stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _get(self, level, i):
+        start, stop = self.offsets[level][i], self.offsets[level][i + 1]
+        if level == len(self.offsets) - 1:
+            return [self.vocab[each] for each in self.values[start:stop]]
+        return [self._get(level + 1, j) for j in range(start, stop)]
+
+    def _sub(self, start, stop):
+        return NestedArray(self.values, self.offsets[1:], self.vocab, start=start, stop=stop)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        i += self.start
+        if len(self.offsets) > 2:
+            return self._sub(int(self.offsets[0][i]), int(self.offsets[0][i + 1]))
+        return self._get(0, i)
+
+    def get_ids(self):
+        """
+        :return: NestedIdArray over the same arrays
+        """
+        return NestedIdArray(self.values, self.offsets, start=self.start, stop=self.stop)
+
+
+class NestedIdArray(NestedArray):
+    """
+    NestedArray of the vocab ids plus 1 (so that 0 can pad) instead of the tokens:
+    the innermost two levels are a padded [num_lists, max_len] int32 array (a 1D array for a column of depth 2),
+    read from the flat arrays only when indexed.
+    """
+    def __init__(self, values, offsets, start=0, stop=None):
+        super(NestedIdArray, self).__init__(values, offsets, None, start=start, stop=stop)
+
+    def _get(self, level, i):
+        start, stop = int(self.offsets[level][i]), int(self.offsets[level][i + 1])
+        if level == len(self.offsets) - 1:
+            return np.asarray(self.values[start:stop], dtype='int32') + 1
+        value_offsets = np.asarray(self.offsets[level + 1][start:stop + 1], dtype='int64')
+        lens = np.diff(value_offsets)
+        ids = np.zeros([len(lens), lens.max() if len(lens) > 0 else 0], dtype='int32')
+        ids[np.arange(ids.shape[1]) < lens[:, None]] = \
+            np.asarray(self.values[value_offsets[0]:value_offsets[-1]], dtype='int32') + 1
+        return ids
+
+    def _sub(self, start, stop):
+        return NestedIdArray(self.values, self.offsets[1:], start=start, stop=stop)
+
+
+def _flatten(l, offsets, values):
+    """
+    Append the items of nested list l to values and their lengths to offsets (one list per nesting level)
+    """
+    for each in l:
+        if len(offsets) == 0:
+            values.append(each)
+        else:
+            offsets[0].append(offsets[0][-1] + len(each))
+            _flatten(each, offsets[1:], values)
+
+
+def save_columnar(dir_path, columns):
+    """
+    Save nested lists of tokens as vocab-id and offset .npy arrays, plus vocab.json and meta.json.
+    :param dir_path:
+    :param columns: {name: (nested list of tokens, depth)}, e.g. depth is 2 for a list of questions (lists of words)
+    :return:
+    """
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    word2idx = {}
+    meta = {}
+    for name, (l, depth) in columns.items():
+        offsets = [[0] for _ in range(depth - 1)]
+        values = []
+        _flatten(l, offsets, values)
+        ids = np.array([word2idx.setdefault(each, len(word2idx)) for each in values], dtype='int32')
+        np.save(os.path.join(dir_path, "{}.npy".format(name)), ids)
+        for level, level_offsets in enumerate(offsets):
+            np.save(os.path.join(dir_path, "{}.offsets{}.npy".format(name, level)), np.array(level_offsets, dtype='int64'))
+        meta[name] = depth
+    idx2word = sorted(word2idx, key=word2idx.get)
+    with open(os.path.join(dir_path, "vocab.json"), 'w') as fh:
+        json.dump(idx2word, fh)
+    with open(os.path.join(dir_path, "meta.json"), 'w') as fh:
+        json.dump(meta, fh)
+
+
+def load_columnar(dir_path, mmap_mode='r'):
+    """
+    Memory-map columns saved by save_columnar.
+    :param dir_path:
+    :param mmap_mode:
+    :return: {name: NestedArray of tokens}
+    """
+    with open(os.path.join(dir_path, "vocab.json"), 'r') as fh:
+        idx2word = json.load(fh)
+    with open(os.path.join(dir_path, "meta.json"), 'r') as fh:
+        meta = json.load(fh)
+
+    columns = {}
+    for name, depth in meta.items():
+        values = np.load(os.path.join(dir_path, "{}.npy".format(name)), mmap_mode=mmap_mode)
+        offsets = [np.load(os.path.join(dir_path, "{}.offsets{}.npy".format(name, level)), mmap_mode=mmap_mode)
+                   for level in range(depth - 1)]
+        columns[name] = NestedArray(values, offsets, idx2word)
+    return columns
+
+
+class RaggedArray(object):
+    """
+    Read-only list of 2D arrays of different shapes, stored as one flat array plus per-item shapes and offsets.
+    Items are returned as float32 arrays (the values may be stored as float16).
+    """
+    def __init__(self, values, shapes, offsets):
+        self.values = values
+        self.shapes = shapes
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        values = self.values[self.offsets[i]:self.offsets[i + 1]]
+        return np.asarray(values, dtype='float32').reshape(self.shapes[i])
+
+
+def save_ragged_dict(dir_path, d, ragged_keys, dtype='float32', lens=None):
+    """
+    Save a dict whose ragged_keys map to lists of 2D arrays (e.g. padded probabilities) as flat .npy arrays;
+    the other values go to meta.json.
+    :param dir_path:
+    :param d:
+    :param ragged_keys:
+    :param dtype: float16 | float32
+    :param lens: if given, the real lengths of the rows of each item (e.g. tokens per sentence), saved as 'lens' in
+        meta.json; each array is then cropped to len(lens[i]) x max(lens[i]) (at least 1), dropping the padding
+    :return:
+    """
+    if not os.path.exists(dir_path):
+        os.makedirs(dir_path)
+    meta = {key: val for key, val in d.items() if key not in ragged_keys}
+    meta['ragged_keys'] = [key for key in ragged_keys if key in d]
+    if lens is not None:
+        meta['lens'] = lens
+    for key in meta['ragged_keys']:
+        arrays = [np.asarray(each) for each in d[key]]
+        if lens is not None:
+            assert len(lens) == len(arrays), (key, len(lens), len(arrays))
+            arrays = [each[:len(item_lens), :max(max(item_lens), 1)] for each, item_lens in zip(arrays, lens)]
+        shapes = np.array([each.shape for each in arrays], dtype='int32').reshape([-1, 2])
+        offsets = np.zeros([len(arrays) + 1], dtype='int64')
+        offsets[1:] = np.cumsum(np.prod(shapes, axis=1))
+        values = np.concatenate([each.ravel() for each in arrays]) if len(arrays) > 0 else np.zeros([0])
+        np.save(os.path.join(dir_path, "{}.npy".format(key)), values.astype(dtype))
+        np.save(os.path.join(dir_path, "{}.shapes.npy".format(key)), shapes)
+        np.save(os.path.join(dir_path, "{}.offsets.npy".format(key)), offsets)
+    with open(os.path.join(dir_path, "meta.json"), 'w') as fh:
+        json.dump(meta, fh)
+
+
+def load_ragged_dict(dir_path, mmap_mode='r'):
+    """
+    Load a dict saved by save_ragged_dict; the ragged values are memory-mapped RaggedArrays.
+    :param dir_path:
+    :param mmap_mode:
+    :return:
+    """
+    with open(os.path.join(dir_path, "meta.json"), 'r') as fh:
+        d = json.load(fh)
+    for key in d.pop('ragged_keys'):
+        d[key] = RaggedArray(*[np.load(os.path.join(dir_path, "{}{}.npy".format(key, suffix)), mmap_mode=mmap_mode)
+                               for suffix in ('', '.shapes', '.offsets')])
+    return d
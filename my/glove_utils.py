@@ -0,0 +1,98 @@
+import json
+import os
+
+import numpy as np
+from tqdm import tqdm
+
+_glove_cache = {}
+
+
+def get_glove_path(args):
+    return os.path.join(args.glove_dir, "glove.{}.{}d.txt".format(args.glove_corpus, args.glove_vec_size))
+
+
+def convert_glove(glove_path, vec_size):
+    """
+    One-time conversion of the GloVe text file into a vocab index (json) and a float32 matrix (npy),
+    stored next to the text file.
+    :param glove_path: path to glove.*.txt
+    :param vec_size: vector dimension
+    :return: (vocab_path, mat_path)
+    """
+    base_path, _ = os.path.splitext(glove_path)
+    vocab_path = base_path + ".vocab.json"
+    mat_path = base_path + ".npy"
+    if os.path.exists(vocab_path) and os.path.exists(mat_path):
+        return vocab_path, mat_path
+
+    print("converting {} to {} ...".format(glove_path, mat_path))
+    with open(glove_path, 'r', encoding='utf-8') as fh:
+        num_lines = sum(1 for _ in fh)
+    # everything is written aside and renamed, vocab last, so that an interrupted run never leaves a partial cache
+    tmp_suffix = ".{}.tmp".format(os.getpid())
+    words = []
+    mat = np.lib.format.open_memmap(mat_path + ".rows" + tmp_suffix, mode='w+', dtype='float32',
+                                    shape=(num_lines, vec_size))
+    with open(glove_path, 'r', encoding='utf-8') as fh:
+        for line in tqdm(fh, total=num_lines):
+            array = line.lstrip().rstrip().split(" ")
+            if len(array) != vec_size + 1:
+                # a handful of tokens in the large corpora contain spaces
+                continue
+            mat[len(words)] = np.array(array[1:], dtype='float32')
+            words.append(array[0])
+    with open(mat_path + tmp_suffix, 'wb') as fh:
+        np.save(fh, mat[:len(words)])
+    del mat
+    os.remove(mat_path + ".rows" + tmp_suffix)
+    os.replace(mat_path + tmp_suffix, mat_path)
+    with open(vocab_path + tmp_suffix, 'w', encoding='utf-8') as fh:
+        json.dump(words, fh)
+    os.replace(vocab_path + tmp_suffix, vocab_path)
+    return vocab_path, mat_path
+
+
+def load_glove(args):
+    """
+    Load the (cached) GloVe vocab and memory-mapped vectors.
+    :param args: needs glove_dir, glove_corpus, glove_vec_size
+    :return: (words, mat), where mat[i] is the vector of words[i]
+    """
+    glove_path = get_glove_path(args)
+    if glove_path not in _glove_cache:
+        vocab_path, mat_path = convert_glove(glove_path, args.glove_vec_size)
+        with open(vocab_path, 'r', encoding='utf-8') as fh:
+            words = json.load(fh)
+        mat = np.load(mat_path, mmap_mode='r')
+        _glove_cache[glove_path] = words, mat
+    return _glove_cache[glove_path]
+
+
+def get_word2vecs(args, word_counters):
+    """
+    Obtain word2vec dicts for several counters with a single pass over the GloVe vocab.
+    Each GloVe word is matched against the word, its capitalized, lowered and uppered forms, in that order.
+    :param args:
+    :param word_counters: list of Counters (or any containers of words)
+    :return: list of word2vec dicts, one per counter
+    """
+    words, mat = load_glove(args)
+    word2idx_dicts = [{} for _ in word_counters]
+    for idx, word in enumerate(words):
+        variants = (word, word.capitalize(), word.lower(), word.upper())
+        for word_counter, word2idx_dict in zip(word_counters, word2idx_dicts):
+            for each in variants:
+                if each in word_counter:
+                    word2idx_dict[each] = idx
+                    break
+
+    glove_path = get_glove_path(args)
+    word2vec_dicts = []
+    for word_counter, word2idx_dict in zip(word_counters, word2idx_dicts):
+        keys = list(word2idx_dict.keys())
+        vecs = mat[[word2idx_dict[key] for key in keys]] if len(keys) > 0 else []
+        # go through str so that the values are the same as the ones parsed from the text file
+        word2vec_dict = {key: list(map(float, vec.astype(str))) for key, vec in zip(keys, vecs)}
+        print("{}/{} of word vocab have corresponding vectors in {}".format(len(word2vec_dict), len(word_counter), glove_path))
+        word2vec_dicts.append(word2vec_dict)
+    return word2vec_dicts
@@ -1,5 +1,7 @@
 import json
+import threading
 from collections import deque
+from queue import Queue, Full
 
 import numpy as np
 from tqdm import tqdm
@@ -56,3 +58,77 @@ def argmax(x):
     return np.unravel_index(x.argmax(), x.shape)
 
 
+def get_emb_mat(word2vec_dict, word2idx_dict, vocab_size, emb_size, dtype='float64'):
+    """
+    Embedding matrix whose rows are the vectors of the words of word2idx_dict found in word2vec_dict,
+    and standard normal draws for the other rows.
+    :param word2vec_dict:
+    :param word2idx_dict:
+    :param vocab_size: number of rows
+    :param emb_size: number of columns
+    :param dtype:
+    :return:
+    """
+    idxs, vecs = [], []
+    for word, idx in word2idx_dict.items():
+        if word in word2vec_dict:
+            idxs.append(idx)
+            vecs.append(word2vec_dict[word])
+    emb_mat = np.empty([vocab_size, emb_size], dtype=dtype)
+    missing = np.ones([vocab_size], dtype='bool')
+    if len(idxs) > 0:
+        emb_mat[idxs] = vecs
+        missing[idxs] = False
+    emb_mat[missing] = np.random.standard_normal([int(missing.sum()), emb_size])
+    return emb_mat
+
+
+def prefetch(iterable, depth):
+    """
+    Iterate over iterable in a background thread, keeping up to depth items ready.
+    Exceptions raised while producing items are re-raised in the consuming thread.
+    :param iterable:
+    :param depth: max number of items waiting in the queue; 0 iterates synchronously
+    :return: generator over the items of iterable
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+
+    queue = Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def _put(item):
+        # gives up once the consumer has stopped, so that the thread does not block on a full queue forever
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as e:
+            _put((None, e))
+        _put((done, None))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = queue.get()
+            if error is not None:
+                raise error
+            if item is done:
+                break
+            yield item
+    finally:
+        # also when the consumer stops early (an exception, or the generator is closed)
+        stop.set()
+    thread.join()
@@ -1,14 +1,19 @@
 import argparse
+import functools
 import json
+import multiprocessing
 import os
 # data: q, cq, (dq), (pq), y, *x, *cx
 # shared: x, cx, (dx), (px), word_counter, char_counter, word2vec
 # no metadata
 from collections import Counter
 
+import numpy as np
 from tqdm import tqdm
 
-from squad.utils import get_word_span, get_word_idx, process_tokens
+from my.columnar import save_columnar
+from my.glove_utils import get_word2vecs
+from squad.utils import get_word_span, get_word_idx, process_tokens, get_span_index, get_length_stats
 
 
 def main():
@@ -35,6 +40,9 @@ def get_args():
     parser.add_argument("--url", default="vision-server2.corp.ai2", type=str)
     parser.add_argument("--port", default=8000, type=int)
     parser.add_argument("--split", action='store_true')
+    parser.add_argument("--num_workers", default=1, type=int)
+    parser.add_argument("--columnar", action='store_true')
+    parser.add_argument("--skip_chars", action='store_true')
     # TODO : put more args here
     return parser.parse_args()
 
@@ -75,36 +83,21 @@ def prepro(args):
 
 
 def save(args, data, shared, data_type):
+    stats_path = os.path.join(args.target_dir, "stats_{}.npz".format(data_type))
+    np.savez(stats_path, **get_length_stats(data, shared))
+    if args.columnar:
+        # tokens go to memory-mappable id arrays; characters are derived from them when feeding the model
+        columnar_dir = os.path.join(args.target_dir, "columnar_{}".format(data_type))
+        save_columnar(columnar_dir, {'x': (shared['x'], 4), 'q': (data['q'], 2)})
+        data = {key: val for key, val in data.items() if key not in ('q', 'cq', '*cx')}
+        shared = {key: val for key, val in shared.items() if key not in ('x', 'cx')}
     data_path = os.path.join(args.target_dir, "data_{}.json".format(data_type))
     shared_path = os.path.join(args.target_dir, "shared_{}.json".format(data_type))
     json.dump(data, open(data_path, 'w'))
     json.dump(shared, open(shared_path, 'w'))
 
 
-def get_word2vec(args, word_counter):
-    glove_path = os.path.join(args.glove_dir, "glove.{}.{}d.txt".format(args.glove_corpus, args.glove_vec_size))
-    sizes = {'6B': int(4e5), '42B': int(1.9e6), '840B': int(2.2e6), '2B': int(1.2e6)}
-    total = sizes[args.glove_corpus]
-    word2vec_dict = {}
-    with open(glove_path, 'r', encoding='utf-8') as fh:
-        for line in tqdm(fh, total=total):
-            array = line.lstrip().rstrip().split(" ")
-            word = array[0]
-            vector = list(map(float, array[1:]))
-            if word in word_counter:
-                word2vec_dict[word] = vector
-            elif word.capitalize() in word_counter:
-                word2vec_dict[word.capitalize()] = vector
-            elif word.lower() in word_counter:
-                word2vec_dict[word.lower()] = vector
-            elif word.upper() in word_counter:
-                word2vec_dict[word.upper()] = vector
-
-    print("{}/{} of word vocab have corresponding vectors in {}".format(len(word2vec_dict), len(word_counter), glove_path))
-    return word2vec_dict
-
-
-def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0, out_name="default", in_path=None):
+def get_tokenizers(args):
     if args.tokenizer == "PTB":
         import nltk
         sent_tokenize = nltk.sent_tokenize
@@ -120,7 +113,110 @@ def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0, out_name="defa
 
     if not args.split:
         sent_tokenize = lambda para: [para]
+    return sent_tokenize, word_tokenize
+
+
+def prepro_article(args, ai, article):
+    """
+    Tokenize a single article and align its answers.
+    Kept at module level so that it can be shipped to worker processes.
+    :param args:
+    :param ai: article index within the processed range
+    :param article: article dict of the source json
+    :return: (out, counters), where out holds the per-question lists and the article's x, cx, p
+    """
+    sent_tokenize, word_tokenize = get_tokenizers(args)
+    q, cq, y, rx, rcx, ids = [], [], [], [], [], []
+    cy = []
+    answerss = []
+    xp, cxp = [], []
+    pp = []
+    word_counter, char_counter, lower_word_counter = Counter(), Counter(), Counter()
+    for pi, para in enumerate(article['paragraphs']):
+        # wordss
+        context = para['context']
+        context = context.replace("''", '" ')
+        context = context.replace("``", '" ')
+        xi = list(map(word_tokenize, sent_tokenize(context)))
+        xi = [process_tokens(tokens) for tokens in xi]  # process tokens
+        # given xi, add chars
+        cxi = None if args.skip_chars else [[list(xijk) for xijk in xij] for xij in xi]
+        xp.append(xi)
+        cxp.append(cxi)
+        pp.append(context)
+
+        for xij in xi:
+            for xijk in xij:
+                word_counter[xijk] += len(para['qas'])
+                lower_word_counter[xijk.lower()] += len(para['qas'])
+                for xijkl in xijk:
+                    char_counter[xijkl] += len(para['qas'])
+
+        rxi = [ai, pi]
+        assert len(xp) - 1 == pi
+        span_index = None
+        for qa in para['qas']:
+            # get words
+            qi = word_tokenize(qa['question'])
+            cqi = None if args.skip_chars else [list(qij) for qij in qi]
+            yi = []
+            cyi = []
+            answers = []
+            for answer in qa['answers']:
+                answer_text = answer['text']
+                answers.append(answer_text)
+                answer_start = answer['answer_start']
+                answer_stop = answer_start + len(answer_text)
+                # TODO : put some function that gives word_start, word_stop here
+                span_index = span_index or get_span_index(context, xi)
+                yi0, yi1 = get_word_span(context, xi, answer_start, answer_stop, span_index=span_index)
+                # yi0 = answer['answer_word_start'] or [0, 0]
+                # yi1 = answer['answer_word_stop'] or [0, 1]
+                assert len(xi[yi0[0]]) > yi0[1]
+                assert len(xi[yi1[0]]) >= yi1[1]
+                w0 = xi[yi0[0]][yi0[1]]
+                w1 = xi[yi1[0]][yi1[1]-1]
+                i0 = get_word_idx(context, xi, yi0, span_index=span_index)
+                i1 = get_word_idx(context, xi, (yi1[0], yi1[1]-1), span_index=span_index)
+                cyi0 = answer_start - i0
+                cyi1 = answer_stop - i1 - 1
+                # print(answer_text, w0[cyi0:], w1[:cyi1+1])
+                assert answer_text[0] == w0[cyi0], (answer_text, w0, cyi0)
+                assert answer_text[-1] == w1[cyi1]
+                assert cyi0 < 32, (answer_text, w0)
+                assert cyi1 < 32, (answer_text, w1)
+
+                yi.append([yi0, yi1])
+                cyi.append([cyi0, cyi1])
+
+            for qij in qi:
+                word_counter[qij] += 1
+                lower_word_counter[qij.lower()] += 1
+                for qijk in qij:
+                    char_counter[qijk] += 1
+
+            q.append(qi)
+            cq.append(cqi)
+            y.append(yi)
+            cy.append(cyi)
+            rx.append(rxi)
+            rcx.append(rxi)
+            ids.append(qa['id'])
+            answerss.append(answers)
+
+        if args.debug:
+            break
+
+    out = {'q': q, 'cq': cq, 'y': y, '*x': rx, '*cx': rcx, 'cy': cy, 'ids': ids, 'answerss': answerss,
+           'x': xp, 'cx': cxp, 'p': pp}
+    return out, (word_counter, char_counter, lower_word_counter)
+
+
+def _prepro_article(args, ai_article):
+    return prepro_article(args, *ai_article)
+
 
+def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0, out_name="default", in_path=None):
     source_path = in_path or os.path.join(args.source_dir, "{}-v1.1.json".format(data_type))
     source_data = json.load(open(source_path, 'r'))
 
@@ -132,89 +228,39 @@ def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0, out_name="defa
     word_counter, char_counter, lower_word_counter = Counter(), Counter(), Counter()
     start_ai = int(round(len(source_data['data']) * start_ratio))
     stop_ai = int(round(len(source_data['data']) * stop_ratio))
-    for ai, article in enumerate(tqdm(source_data['data'][start_ai:stop_ai])):
-        xp, cxp = [], []
-        pp = []
-        x.append(xp)
-        cx.append(cxp)
-        p.append(pp)
-        for pi, para in enumerate(article['paragraphs']):
-            # wordss
-            context = para['context']
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
-            xi = list(map(word_tokenize, sent_tokenize(context)))
-            xi = [process_tokens(tokens) for tokens in xi]  # process tokens
-            # given xi, add chars
-            cxi = [[list(xijk) for xijk in xij] for xij in xi]
-            xp.append(xi)
-            cxp.append(cxi)
-            pp.append(context)
-
-            for xij in xi:
-                for xijk in xij:
-                    word_counter[xijk] += len(para['qas'])
-                    lower_word_counter[xijk.lower()] += len(para['qas'])
-                    for xijkl in xijk:
-                        char_counter[xijkl] += len(para['qas'])
-
-            rxi = [ai, pi]
-            assert len(x) - 1 == ai
-            assert len(x[ai]) - 1 == pi
-            for qa in para['qas']:
-                # get words
-                qi = word_tokenize(qa['question'])
-                cqi = [list(qij) for qij in qi]
-                yi = []
-                cyi = []
-                answers = []
-                for answer in qa['answers']:
-                    answer_text = answer['text']
-                    answers.append(answer_text)
-                    answer_start = answer['answer_start']
-                    answer_stop = answer_start + len(answer_text)
-                    # TODO : put some function that gives word_start, word_stop here
-                    yi0, yi1 = get_word_span(context, xi, answer_start, answer_stop)
-                    # yi0 = answer['answer_word_start'] or [0, 0]
-                    # yi1 = answer['answer_word_stop'] or [0, 1]
-                    assert len(xi[yi0[0]]) > yi0[1]
-                    assert len(xi[yi1[0]]) >= yi1[1]
-                    w0 = xi[yi0[0]][yi0[1]]
-                    w1 = xi[yi1[0]][yi1[1]-1]
-                    i0 = get_word_idx(context, xi, yi0)
-                    i1 = get_word_idx(context, xi, (yi1[0], yi1[1]-1))
-                    cyi0 = answer_start - i0
-                    cyi1 = answer_stop - i1 - 1
-                    # print(answer_text, w0[cyi0:], w1[:cyi1+1])
-                    assert answer_text[0] == w0[cyi0], (answer_text, w0, cyi0)
-                    assert answer_text[-1] == w1[cyi1]
-                    assert cyi0 < 32, (answer_text, w0)
-                    assert cyi1 < 32, (answer_text, w1)
-
-                    yi.append([yi0, yi1])
-                    cyi.append([cyi0, cyi1])
-
-                for qij in qi:
-                    word_counter[qij] += 1
-                    lower_word_counter[qij.lower()] += 1
-                    for qijk in qij:
-                        char_counter[qijk] += 1
-
-                q.append(qi)
-                cq.append(cqi)
-                y.append(yi)
-                cy.append(cyi)
-                rx.append(rxi)
-                rcx.append(rxi)
-                ids.append(qa['id'])
-                idxs.append(len(idxs))
-                answerss.append(answers)
-
-            if args.debug:
-                break
-
-    word2vec_dict = get_word2vec(args, word_counter)
-    lower_word2vec_dict = get_word2vec(args, lower_word_counter)
+    articles = list(enumerate(source_data['data'][start_ai:stop_ai]))
+
+    # Articles are processed (and merged) in order, so counters keep the same insertion order
+    # and the dumped json is byte-identical regardless of the number of workers.
+    pool = None
+    if args.num_workers > 1:
+        pool = multiprocessing.Pool(args.num_workers)
+        chunk_size = max(1, len(articles) // (args.num_workers * 16))
+        outs = pool.imap(functools.partial(_prepro_article, args), articles, chunksize=chunk_size)
+    else:
+        outs = (_prepro_article(args, ai_article) for ai_article in articles)
+
+    for out, counters in tqdm(outs, total=len(articles)):
+        q.extend(out['q'])
+        cq.extend(out['cq'])
+        y.extend(out['y'])
+        cy.extend(out['cy'])
+        rx.extend(out['*x'])
+        rcx.extend(out['*cx'])
+        ids.extend(out['ids'])
+        answerss.extend(out['answerss'])
+        x.append(out['x'])
+        cx.append(out['cx'])
+        p.append(out['p'])
+        for counter, each in zip((word_counter, char_counter, lower_word_counter), counters):
+            counter.update(each)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+    idxs.extend(range(len(q)))
+
+    word2vec_dict, lower_word2vec_dict = get_word2vecs(args, [word_counter, lower_word_counter])
 
     # add context here
     data = {'q': q, 'cq': cq, 'y': y, '*x': rx, '*cx': rcx, 'cy': cy,
@@ -223,6 +269,12 @@ def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0, out_name="defa
               'word_counter': word_counter, 'char_counter': char_counter, 'lower_word_counter': lower_word_counter,
               'word2vec': word2vec_dict, 'lower_word2vec': lower_word2vec_dict}
 
+    if args.skip_chars:
+        # characters are derived from x and q when feeding the model
+        for key in ('cq', '*cx'):
+            del data[key]
+        del shared['cx']
+
     print("saving ...")
     save(args, data, shared, out_name)
 
@@ -9,6 +9,7 @@ from collections import Counter
 import nltk
 from tqdm import tqdm
 
+from my.glove_utils import get_word2vecs
 from my.nltk_utils import load_compressed_tree
 
 
@@ -68,29 +69,6 @@ def save(args, data, shared, data_type):
     json.dump(shared, open(shared_path, 'w'))
 
 
-def get_word2vec(args, word_counter):
-    glove_path = os.path.join(args.glove_dir, "glove.{}.{}d.txt".format(args.glove_corpus, args.glove_vec_size))
-    sizes = {'6B': int(4e5), '42B': int(1.9e6), '840B': int(2.2e6), '2B': int(1.2e6)}
-    total = sizes[args.glove_corpus]
-    word2vec_dict = {}
-    with open(glove_path, 'r') as fh:
-        for line in tqdm(fh, total=total):
-            array = line.lstrip().rstrip().split(" ")
-            word = array[0]
-            vector = list(map(float, array[1:]))
-            if word in word_counter:
-                word2vec_dict[word] = vector
-            elif word.capitalize() in word_counter:
-                word2vec_dict[word.capitalize()] = vector
-            elif word.lower() in word_counter:
-                word2vec_dict[word.lower()] = vector
-            elif word.upper() in word_counter:
-                word2vec_dict[word.upper()] = vector
-
-    print("{}/{} of word vocab have corresponding vectors in {}".format(len(word2vec_dict), len(word_counter), glove_path))
-    return word2vec_dict
-
-
 def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0):
     source_path = os.path.join(args.source_dir, "{}-v1.0-aug.json".format(data_type))
     source_data = json.load(open(source_path, 'r'))
@@ -167,8 +145,7 @@ def prepro_each(args, data_type, start_ratio=0.0, stop_ratio=1.0):
             if args.debug:
                 break
 
-    word2vec_dict = get_word2vec(args, word_counter)
-    lower_word2vec_dict = get_word2vec(args, lower_word_counter)
+    word2vec_dict, lower_word2vec_dict = get_word2vecs(args, [word_counter, lower_word_counter])
 
     data = {'q': q, 'cq': cq, 'y': y, '*x': rx, '*cx': rcx, '*tx': rx, '*stx': rx,
             'idxs': idxs, 'ids': ids, 'answerss': answerss}
@@ -1,4 +1,7 @@
 import re
+from bisect import bisect_left, bisect_right
+
+import numpy as np
 
 
 def get_2d_spans(text, tokenss):
@@ -18,53 +21,65 @@ def get_2d_spans(text, tokenss):
     return spanss
 
 
-def get_word_span(context, wordss, start, stop):
-    spanss = get_2d_spans(context, wordss)
-    idxs = []
-    for sent_idx, spans in enumerate(spanss):
-        for word_idx, span in enumerate(spans):
-            if not (stop <= span[0] or start >= span[1]):
-                idxs.append((sent_idx, word_idx))
+def get_span_index(context, wordss):
+    """
+    Character offsets of every token, computed once per paragraph.
+    :param context:
+    :param wordss:
+    :return: (starts, stops, sent_starts), where starts/stops are flat over all tokens of wordss
+        and sent_starts[i] is the flat index of the first token of sentence i
+    """
+    starts, stops, sent_starts = [], [], []
+    for spans in get_2d_spans(context, wordss):
+        sent_starts.append(len(starts))
+        for start, stop in spans:
+            starts.append(start)
+            stops.append(stop)
+    return starts, stops, sent_starts
+
+
+def _unflatten_idx(sent_starts, flat_idx):
+    sent_idx = bisect_right(sent_starts, flat_idx) - 1
+    return sent_idx, flat_idx - sent_starts[sent_idx]
 
-    assert len(idxs) > 0, "{} {} {} {}".format(context, spanss, start, stop)
-    return idxs[0], (idxs[-1][0], idxs[-1][1] + 1)
 
+def get_word_span(context, wordss, start, stop, span_index=None):
+    span_index = span_index or get_span_index(context, wordss)
+    starts, stops, sent_starts = span_index
+    # tokens are ordered by position, so the ones overlapping [start, stop) are a contiguous range
+    first = bisect_right(stops, start)
+    last = bisect_left(starts, stop) - 1
+    assert first <= last, "{} {} {} {}".format(context, wordss, start, stop)
+    first_idx = _unflatten_idx(sent_starts, first)
+    last_idx = _unflatten_idx(sent_starts, last)
+    return first_idx, (last_idx[0], last_idx[1] + 1)
 
-def get_phrase(context, wordss, span):
+
+def get_phrase(context, wordss, span, span_index=None):
     """
     Obtain phrase as substring of context given start and stop indices in word level
     :param context:
     :param wordss:
-    :param start: [sent_idx, word_idx]
-    :param stop: [sent_idx, word_idx]
+    :param span: ([sent_idx, word_idx], [sent_idx, word_idx]) of start and stop
+    :param span_index: output of get_span_index(context, wordss), if already available
     :return:
     """
     start, stop = span
-    flat_start = get_flat_idx(wordss, start)
-    flat_stop = get_flat_idx(wordss, stop)
-    words = sum(wordss, [])
-    char_idx = 0
-    char_start, char_stop = None, None
-    for word_idx, word in enumerate(words):
-        char_idx = context.find(word, char_idx)
-        assert char_idx >= 0
-        if word_idx == flat_start:
-            char_start = char_idx
-        char_idx += len(word)
-        if word_idx == flat_stop - 1:
-            char_stop = char_idx
-    assert char_start is not None
-    assert char_stop is not None
-    return context[char_start:char_stop]
+    starts, stops, sent_starts = span_index or get_span_index(context, wordss)
+    assert 0 <= start[0] < len(sent_starts) and 0 <= stop[0] < len(sent_starts), span
+    flat_start = sent_starts[start[0]] + start[1]
+    flat_stop = sent_starts[stop[0]] + stop[1]
+    assert 0 <= flat_start < flat_stop <= len(starts), span
+    return context[starts[flat_start]:stops[flat_stop - 1]]
 
 
 def get_flat_idx(wordss, idx):
     return sum(len(words) for words in wordss[:idx[0]]) + idx[1]
 
 
-def get_word_idx(context, wordss, idx):
-    spanss = get_2d_spans(context, wordss)
-    return spanss[idx[0]][idx[1]][0]
+def get_word_idx(context, wordss, idx, span_index=None):
+    starts, stops, sent_starts = span_index or get_span_index(context, wordss)
+    return starts[sent_starts[idx[0]] + idx[1]]
 
 
 def process_tokens(temp_tokens):
@@ -79,24 +94,81 @@ def process_tokens(temp_tokens):
     return tokens
 
 
-def get_best_span(ypi, yp2i):
-    max_val = 0
-    best_word_span = (0, 1)
-    best_sent_idx = 0
-    for f, (ypif, yp2if) in enumerate(zip(ypi, yp2i)):
-        argmax_j1 = 0
-        for j in range(len(ypif)):
-            val1 = ypif[argmax_j1]
-            if val1 < ypif[j]:
-                val1 = ypif[j]
-                argmax_j1 = j
-
-            val2 = yp2if[j]
-            if val1 * val2 > max_val:
-                best_word_span = (argmax_j1, j)
-                best_sent_idx = f
-                max_val = val1 * val2
-    return ((best_sent_idx, best_word_span[0]), (best_sent_idx, best_word_span[1] + 1)), float(max_val)
+def get_length_stats(data, shared):
+    """
+    Length statistics of every example, as numpy arrays, so that data filters and max sizes are vectorized.
+    Answer statistics are flattened over the answers of all examples, and 'answer_idxs' maps each answer to its example.
+    :param data:
+    :param shared:
+    :return: dict of numpy arrays
+    """
+    para_stats = {}
+    keys = ('ques_size', 'num_sents', 'max_sent_size', 'para_size', 'max_word_size')
+    answer_keys = ('answer_idxs', 'start_sent', 'stop_sent', 'stop_word', 'para_stop_word', 'start_sent_size')
+    stats = {key: [] for key in keys + answer_keys}
+    for idx, (rx, q, y) in enumerate(zip(data['*x'], data['q'], data['y'])):
+        rx = tuple(rx)
+        if rx not in para_stats:
+            sents = shared['x'][rx[0]][rx[1]]
+            sent_sizes = [len(sent) for sent in sents]
+            offsets = [0]
+            for sent_size in sent_sizes:
+                offsets.append(offsets[-1] + sent_size)
+            max_word_size = max((len(word) for sent in sents for word in sent), default=0)
+            para_stats[rx] = sent_sizes, offsets, max_word_size
+        sent_sizes, offsets, max_word_size = para_stats[rx]
+        stats['ques_size'].append(len(q))
+        stats['num_sents'].append(len(sent_sizes))
+        stats['max_sent_size'].append(max(sent_sizes, default=0))
+        stats['para_size'].append(offsets[-1])
+        stats['max_word_size'].append(max([max_word_size] + [len(word) for word in q]))
+        for start, stop in y:
+            stats['answer_idxs'].append(idx)
+            stats['start_sent'].append(start[0])
+            stats['stop_sent'].append(stop[0])
+            stats['stop_word'].append(stop[1])
+            stats['para_stop_word'].append(offsets[stop[0]] + stop[1])
+            stats['start_sent_size'].append(sent_sizes[start[0]])
+    return {key: np.array(val, dtype='int64') for key, val in stats.items()}
+
+
+def get_best_span(ypi, yp2i, max_answer_len=None):
+    spans, scores = get_best_spans(np.array([ypi]), np.array([yp2i]), max_answer_len=max_answer_len)
+    return spans[0], scores[0]
+
+
+def get_best_spans(yp, yp2, max_answer_len=None):
+    """
+    Batched get_best_span: for each example, the span within a sentence maximizing yp[start] * yp2[stop].
+    Ties are broken as in the sequential search (earliest sentence, stop and then start win).
+    :param yp: [N, M, JX] start probabilities
+    :param yp2: [N, M, JX] stop probabilities
+    :param max_answer_len: if given, spans are at most this many words long
+    :return: (spans, scores), where spans[i] = ((sent_idx, start), (sent_idx, stop + 1))
+    """
+    yp, yp2 = np.asarray(yp, dtype='float64'), np.asarray(yp2, dtype='float64')
+    N, M, JX = yp.shape
+    if max_answer_len is None or max_answer_len >= JX:
+        # running max of yp over starts <= stop, with the first argmax
+        max_yp = np.maximum.accumulate(yp, axis=2)
+        is_new_max = np.ones_like(yp, dtype='bool')
+        is_new_max[:, :, 1:] = yp[:, :, 1:] > max_yp[:, :, :-1]
+        argmax_yp = np.maximum.accumulate(np.where(is_new_max, np.arange(JX), 0), axis=2)
+    else:
+        # max of yp over the last max_answer_len starts, the earliest start winning ties
+        padded = np.pad(yp, [(0, 0), (0, 0), (max_answer_len - 1, 0)], mode='constant', constant_values=-np.inf)
+        windows = np.stack([padded[:, :, k:k + JX] for k in range(max_answer_len)], axis=3)  # [N, M, JX, L]
+        offsets = np.argmax(windows, axis=3)
+        max_yp = np.max(windows, axis=3)
+        argmax_yp = np.arange(JX) - (max_answer_len - 1) + offsets
+    scores = np.reshape(max_yp * yp2, [N, M * JX])
+    flat_idxs = np.argmax(scores, axis=1)
+    sent_idxs, stops = np.unravel_index(flat_idxs, (M, JX))
+    starts = argmax_yp[np.arange(N), sent_idxs, stops]
+    best_scores = scores[np.arange(N), flat_idxs]
+    spans = [((int(f), int(j)), (int(f), int(k) + 1)) if score > 0 else ((0, 0), (0, 2))  # default of get_best_span
+             for f, j, k, score in zip(sent_idxs, starts, stops, best_scores)]
+    return spans, [float(score) if score > 0 else 0.0 for score in best_scores]
 
 
 def get_span_score_pairs(ypi, yp2i):
@@ -0,0 +1,79 @@
+import numpy as np
+
+from my.columnar import save_columnar, load_columnar, save_ragged_dict, load_ragged_dict
+
+
+def _random_tokens(rng, depth):
+    if depth == 1:
+        return "".join(rng.choice(list("abcd"), size=rng.randint(1, 4)))
+    return [_random_tokens(rng, depth - 1) for _ in range(rng.randint(0, 4))]
+
+
+def test_columnar_round_trip(tmpdir):
+    rng = np.random.RandomState(0)
+    x = [_random_tokens(rng, 4) for _ in range(5)]  # articles of paragraphs of sentences of words
+    q = [_random_tokens(rng, 2) for _ in range(20)]  # questions of words
+    save_columnar(str(tmpdir), {'x': (x, 4), 'q': (q, 2)})
+    columns = load_columnar(str(tmpdir))
+    assert len(columns['x']) == len(x) and len(columns['q']) == len(q)
+    assert [[para for para in article] for article in columns['x']] == x
+    assert list(columns['q']) == q
+    assert columns['q'][-1] == q[-1] and columns['q'][2:5] == q[2:5]
+
+
+def test_columnar_ids_match_vocab(tmpdir):
+    rng = np.random.RandomState(1)
+    x = [_random_tokens(rng, 4) for _ in range(5)]
+    q = [_random_tokens(rng, 2) for _ in range(20)]
+    save_columnar(str(tmpdir), {'x': (x, 4), 'q': (q, 2)})
+    columns = load_columnar(str(tmpdir))
+    vocab = columns['x'].vocab
+    x_ids, q_ids = columns['x'].get_ids(), columns['q'].get_ids()
+    for ai, article in enumerate(x):
+        for pi, para in enumerate(article):
+            ids = x_ids[ai][pi]
+            assert ids.dtype == np.int32 and ids.shape == (len(para), max(map(len, para), default=0))
+            for j, sent in enumerate(para):
+                assert [vocab[idx - 1] for idx in ids[j, :len(sent)]] == sent
+                assert not ids[j, len(sent):].any()
+    for ids, ques in zip(q_ids, q):
+        assert [vocab[idx - 1] for idx in ids] == ques
+
+
+def _pad(a, shape):
+    return np.pad(a, [(0, each - size) for each, size in zip(shape, a.shape)], mode='constant')
+
+
+def test_ragged_dict_round_trip(tmpdir):
+    rng = np.random.RandomState(2)
+    yp, lens = [], []
+    for _ in range(30):
+        a = rng.rand(4, 8)
+        item_lens = rng.randint(0, 8, size=rng.randint(1, 5)).tolist()
+        for row, length in zip(a, item_lens):
+            row[length:] = 0  # padding, cropped away when saved
+        a[len(item_lens):] = 0
+        if item_lens[-1] > 0:
+            a[len(item_lens) - 1, item_lens[-1] - 1] = 0  # a real token with a zero prob is kept
+        yp.append(a.tolist())
+        lens.append(item_lens)
+    d = {'yp': yp, 'global_step': 7, 'idxs': list(range(len(yp)))}
+    for dtype, tol in (('float32', 1e-7), ('float16', 1e-3)):
+        path = str(tmpdir.join(dtype))
+        save_ragged_dict(path, d, ['yp', 'missing'], dtype=dtype, lens=lens)
+        loaded = load_ragged_dict(path)
+        assert loaded['global_step'] == 7 and loaded['idxs'] == d['idxs'] and loaded['lens'] == lens
+        assert len(loaded['yp']) == len(yp)
+        for a, b, item_lens in zip(loaded['yp'], yp, lens):
+            b = np.array(b)
+            assert a.dtype == np.float32 and a.shape == (len(item_lens), max(max(item_lens), 1))
+            np.testing.assert_allclose(_pad(a, b.shape), b, atol=tol)
+
+
+def test_ragged_dict_without_lens_is_not_cropped(tmpdir):
+    yp = [[[0.5, 0.0], [0.0, 0.0]], [[0.25, 0.75]]]
+    path = str(tmpdir.join('ragged'))
+    save_ragged_dict(path, {'yp': yp}, ['yp'])
+    loaded = load_ragged_dict(path)
+    assert 'lens' not in loaded
+    assert [a.tolist() for a in loaded['yp']] == yp
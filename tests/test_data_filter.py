@@ -0,0 +1,62 @@
+import argparse
+import itertools
+
+import numpy as np
+import pytest
+
+from squad.utils import get_length_stats
+
+pytest.importorskip("tensorflow")  # basic.read_data imports my.tensorflow
+from basic.read_data import get_squad_data_filter
+
+
+def _data_filter_baseline(config, data, shared, idx):
+    # the per-example SQuAD filter that the vectorized one replaces
+    rx, q, y = data['*x'][idx], data['q'][idx], data['y'][idx]
+    xi = shared['x'][rx[0]][rx[1]]
+    if len(q) > config.ques_size_th:
+        return False
+    if config.squash:
+        return all(sum(map(len, xi[:stop[0]])) + stop[1] <= config.para_size_th for start, stop in y)
+    if config.single and any(start[0] != stop[0] for start, stop in y):
+        return False
+    if config.data_filter == 'max':
+        return all(stop[0] < config.num_sents_th and start[0] == stop[0] and stop[1] < config.sent_size_th
+                   for start, stop in y)
+    elif config.data_filter == 'valid':
+        return len(xi) <= config.num_sents_th and all(len(xij) <= config.sent_size_th for xij in xi)
+    elif config.data_filter == 'semi':
+        return all(stop[0] < config.num_sents_th and len(xi[start[0]]) <= config.sent_size_th for start, stop in y)
+    raise Exception()
+
+
+def _random_data(rng, num_paras=30, num_examples=300):
+    paras = [[['w'] * rng.randint(1, 12) for _ in range(rng.randint(1, 6))] for _ in range(num_paras)]
+    data = {'*x': [], 'q': [], 'y': []}
+    for _ in range(num_examples):
+        pi = rng.randint(len(paras))
+        sents = paras[pi]
+        y = []
+        for _ in range(rng.randint(0, 3)):
+            start_sent = rng.randint(len(sents))
+            stop_sent = rng.randint(start_sent, len(sents))
+            y.append([[start_sent, rng.randint(len(sents[start_sent]))],
+                      [stop_sent, rng.randint(1, len(sents[stop_sent]) + 1)]])
+        data['*x'].append([0, pi])
+        data['q'].append(['w'] * rng.randint(1, 10))
+        data['y'].append(y)
+    return data, {'x': [paras]}
+
+
+@pytest.mark.parametrize("data_filter, squash, single",
+                         list(itertools.product(('max', 'valid', 'semi'), (False, True), (False, True))))
+def test_squad_data_filter_matches_baseline(data_filter, squash, single):
+    rng = np.random.RandomState(0)
+    for _ in range(10):
+        data, shared = _random_data(rng)
+        config = argparse.Namespace(data_filter=data_filter, squash=squash, single=single,
+                                    ques_size_th=rng.randint(1, 10), num_sents_th=rng.randint(1, 6),
+                                    sent_size_th=rng.randint(1, 12), para_size_th=rng.randint(1, 40))
+        mask = get_squad_data_filter(config)(get_length_stats(data, shared))
+        expected = [_data_filter_baseline(config, data, shared, idx) for idx in range(len(data['q']))]
+        assert mask.tolist() == expected
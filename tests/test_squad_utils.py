@@ -0,0 +1,111 @@
+import random
+
+import numpy as np
+
+from squad.utils import get_2d_spans, get_span_index, get_word_span, get_word_idx, get_phrase, get_best_span, \
+    get_best_spans
+
+
+def _get_word_span_baseline(context, wordss, start, stop):
+    # get_word_span before the span index: a scan over the spans of all tokens
+    idxs = []
+    for sent_idx, spans in enumerate(get_2d_spans(context, wordss)):
+        for word_idx, span in enumerate(spans):
+            if not (stop <= span[0] or start >= span[1]):
+                idxs.append((sent_idx, word_idx))
+    if len(idxs) == 0:
+        return None
+    return idxs[0], (idxs[-1][0], idxs[-1][1] + 1)
+
+
+def _random_paragraph(rng):
+    wordss = [["".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(rng.randint(1, 6))]
+              for _ in range(rng.randint(1, 4))]
+    context = " " * rng.randint(0, 2)
+    for words in wordss:
+        for word in words:
+            context += word + " " * rng.randint(0, 2)
+    return context, wordss
+
+
+def test_get_word_span_matches_baseline():
+    rng = random.Random(0)
+    num_checked = 0
+    for _ in range(2000):
+        context, wordss = _random_paragraph(rng)
+        span_index = get_span_index(context, wordss)
+        start = rng.randint(0, len(context) - 1)
+        stop = rng.randint(start + 1, len(context))
+        expected = _get_word_span_baseline(context, wordss, start, stop)
+        if expected is None:
+            continue
+        assert get_word_span(context, wordss, start, stop) == expected
+        assert get_word_span(context, wordss, start, stop, span_index=span_index) == expected
+        num_checked += 1
+    assert num_checked > 1000
+
+
+def test_get_phrase_and_word_idx_use_token_offsets():
+    rng = random.Random(1)
+    for _ in range(200):
+        context, wordss = _random_paragraph(rng)
+        span_index = get_span_index(context, wordss)
+        spanss = get_2d_spans(context, wordss)
+        for sent_idx, words in enumerate(wordss):
+            for word_idx, word in enumerate(words):
+                assert get_word_idx(context, wordss, (sent_idx, word_idx), span_index=span_index) == \
+                    spanss[sent_idx][word_idx][0]
+                span = ((sent_idx, word_idx), (sent_idx, word_idx + 1))
+                assert get_phrase(context, wordss, span, span_index=span_index) == word
+
+
+def test_get_phrase_rejects_spans_outside_the_paragraph():
+    context, wordss = "ab c de", [["ab", "c"], ["de"]]
+    for span in [((0, 0), (0, 0)), ((0, 1), (0, 1)), ((0, 0), (1, 2)), ((2, 0), (2, 1)), ((0, 0), (3, 1))]:
+        try:
+            get_phrase(context, wordss, span)
+        except AssertionError:
+            continue
+        raise AssertionError("no error for {}".format(span))
+    assert get_phrase(context, wordss, ((0, 1), (1, 1))) == "c de"
+
+
+def _get_best_span_baseline(ypi, yp2i, max_answer_len=None):
+    # the sequential search of get_best_span, with starts limited to the last max_answer_len words
+    max_val = 0
+    best_span = ((0, 0), (0, 2))
+    for f, (ypif, yp2if) in enumerate(zip(ypi, yp2i)):
+        for k in range(len(ypif)):
+            first = 0 if max_answer_len is None else max(0, k - max_answer_len + 1)
+            argmax_j = first
+            for j in range(first, k + 1):
+                if ypif[j] > ypif[argmax_j]:
+                    argmax_j = j
+            val = ypif[argmax_j] * yp2if[k]
+            if val > max_val:
+                best_span = ((f, argmax_j), (f, k + 1))
+                max_val = val
+    return best_span, float(max_val)
+
+
+def _random_probs(rng, shape):
+    # coarse values, so that ties and zeros are frequent
+    return rng.randint(0, 5, size=shape) / 4.0
+
+
+def test_get_best_spans_matches_baseline():
+    rng = np.random.RandomState(0)
+    for _ in range(500):
+        N, M, JX = rng.randint(1, 5), rng.randint(1, 4), rng.randint(1, 8)
+        yp, yp2 = _random_probs(rng, [N, M, JX]), _random_probs(rng, [N, M, JX])
+        for max_answer_len in (None, 1, 2, 3, JX):
+            spans, scores = get_best_spans(yp, yp2, max_answer_len=max_answer_len)
+            for i in range(N):
+                assert (spans[i], scores[i]) == _get_best_span_baseline(yp[i], yp2[i], max_answer_len=max_answer_len)
+
+
+def test_get_best_span_wraps_get_best_spans():
+    rng = np.random.RandomState(1)
+    for _ in range(200):
+        ypi, yp2i = rng.rand(3, 6), rng.rand(3, 6)
+        assert get_best_span(ypi.tolist(), yp2i.tolist()) == _get_best_span_baseline(ypi, yp2i)